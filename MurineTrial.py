@@ -2,7 +2,48 @@ import os
 import unittest
 import math
 import numpy
-from __main__ import vtk, qt, ctk, slicer
+import MurineTrialLib
+
+#
+# Slicer puts vtk, qt, ctk and slicer in __main__.  They are only
+# looked up when first used so that the logic (materials discovery,
+# volumetrics, fat ratios) can be imported and run from a plain
+# python interpreter that has only numpy.
+#
+
+class LazySlicerModule(object):
+  def __init__(self,name):
+    self.__dict__['name'] = name
+    self.__dict__['module'] = None
+
+  def load(self):
+    if self.__dict__['module'] is None:
+      import __main__
+      module = getattr(__main__, self.name, None)
+      if module is None:
+        module = __import__(self.name)
+      self.__dict__['module'] = module
+    return self.__dict__['module']
+
+  def __getattr__(self,attribute):
+    return getattr(self.load(), attribute)
+
+  def __setattr__(self,attribute,value):
+    setattr(self.load(), attribute, value)
+
+vtk = LazySlicerModule('vtk')
+qt = LazySlicerModule('qt')
+ctk = LazySlicerModule('ctk')
+slicer = LazySlicerModule('slicer')
+
+def slicerAvailable():
+  """True when running inside Slicer, rather than just having some
+  other module called slicer on the path (shap installs one)"""
+  try:
+    module = slicer.load()
+  except ImportError:
+    return False
+  return hasattr(module, 'mrmlScene')
 
 #
 # MurineTrial
@@ -60,12 +101,14 @@ class MurineTrialWidget:
     else:
       self.parent = parent
     self.layout = self.parent.layout()
+    self.logic = MurineTrialLogic(collect=False)
+    self.discovery = None
+    self.loadTask = None
+    self.watchTask = None
     if not parent:
       self.setup()
       self.parent.show()
 
-    self.logic = MurineTrialLogic()
-
   def setup(self):
     # Instantiate and connect widgets ...
 
@@ -103,11 +146,8 @@ class MurineTrialWidget:
     self.materialsScrollArea.setWidgetResizable(True)
     self.materialsListWidget.setProperty('SH_ItemView_ActivateItemOnSingleClick', 1)
     self.materialsListWidget.connect('activated(QModelIndex)', self.onMaterialActivated)
-    # populate it
-    materialKeys = self.logic.materials.keys()
-    materialKeys.sort()
-    for materialKey in materialKeys:
-      self.materialsListWidget.addItem(materialKey)
+    # populated in the background by startDiscovery
+    self.materialsListWidget.sortingEnabled = True
 
     # list of sampleIDs in the trial
     measurementsFormLayout.addWidget(qt.QLabel("Segmentation Comparisions"))
@@ -118,9 +158,6 @@ class MurineTrialWidget:
     self.sampleIDsScrollArea.setWidgetResizable(True)
     self.sampleIDsListWidget.setProperty('SH_ItemView_ActivateItemOnSingleClick', 1)
     self.sampleIDsListWidget.connect('activated(QModelIndex)', self.onSampleIDActivated)
-    # populate it
-    for sampleID in self.logic.gigSegComparisonSampleIDs():
-      self.sampleIDsListWidget.addItem(sampleID)
 
     # list of retestIDs in the trial
     measurementsFormLayout.addWidget(qt.QLabel("Repeatability Tests"))
@@ -131,15 +168,55 @@ class MurineTrialWidget:
     self.retestIDsScrollArea.setWidgetResizable(True)
     self.retestIDsListWidget.setProperty('SH_ItemView_ActivateItemOnSingleClick', 1)
     self.retestIDsListWidget.connect('activated(QModelIndex)', self.onRetestActivated)
-    # populate it
-    for retestID in self.logic.retestComparisonSampleIDs():
-      self.retestIDsListWidget.addItem(retestID)
+
+    # discovery progress and refresh
+    self.discoveryProgress = qt.QProgressBar()
+    self.discoveryProgress.toolTip = "Searching the data directory for materials."
+    measurementsFormLayout.addWidget(self.discoveryProgress)
+    self.refreshButton = qt.QPushButton("Refresh Materials")
+    self.refreshButton.toolTip = "Re-scan the data directories that changed since the last scan."
+    measurementsFormLayout.addWidget(self.refreshButton)
+    self.refreshButton.connect('clicked()', self.onRefresh)
+    self.discoveryTimer = qt.QTimer()
+    self.discoveryTimer.interval = 100
+    self.discoveryTimer.connect('timeout()', self.onDiscoveryTimer)
+
+    # quick-look previews and refinement to full resolution
+    self.previewCheckBox = qt.QCheckBox("Quick-look previews")
+    self.previewCheckBox.toolTip = "Show downsampled volumes when browsing; use Full Resolution to refine."
+    self.previewCheckBox.checked = True
+    measurementsFormLayout.addWidget(self.previewCheckBox)
+    self.refineButton = qt.QPushButton("Full Resolution")
+    self.refineButton.toolTip = "Replace the previews on display with the full resolution volumes."
+    self.refineButton.enabled = False
+    measurementsFormLayout.addWidget(self.refineButton)
+    self.refineButton.connect('clicked()', self.onRefine)
+
+    # cancel a load in progress
+    self.cancelLoadButton = qt.QPushButton("Cancel Load")
+    self.cancelLoadButton.toolTip = "Stop loading the selected sample."
+    self.cancelLoadButton.enabled = False
+    measurementsFormLayout.addWidget(self.cancelLoadButton)
+    self.cancelLoadButton.connect('clicked()', self.onCancelLoad)
+    self.loadTimer = qt.QTimer()
+    self.loadTimer.interval = 50
+    self.loadTimer.connect('timeout()', self.onLoadTimer)
 
     # process all  button
-    processAllButton = qt.QPushButton("Process All")
-    processAllButton.toolTip = "Loads all subjecs at all timepoints."
-    measurementsFormLayout.addWidget(processAllButton)
-    processAllButton.connect('clicked(bool)', self.logic.processAll)
+    self.processAllButton = qt.QPushButton("Process All")
+    self.processAllButton.toolTip = "Loads all subjecs at all timepoints."
+    measurementsFormLayout.addWidget(self.processAllButton)
+    self.processAllButton.connect('clicked(bool)', self.logic.processAll)
+
+    # watch the data folder for new segmentations
+    self.watchButton = qt.QPushButton("Watch Data Folder")
+    self.watchButton.toolTip = "Update the result files as segmentations are added or changed."
+    self.watchButton.checkable = True
+    measurementsFormLayout.addWidget(self.watchButton)
+    self.watchButton.connect('toggled(bool)', self.onWatchToggled)
+    self.watchTimer = qt.QTimer()
+    self.watchTimer.interval = int(self.logic.watchPollSeconds * 1000)
+    self.watchTimer.connect('timeout()', self.onWatchTimer)
 
     # results area
     self.resultsView = qt.QWebView()
@@ -152,6 +229,145 @@ class MurineTrialWidget:
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # fill the lists without blocking the module from appearing
+    self.startDiscovery(rescanAll=True)
+
+  def cleanup(self):
+    if self.discovery:
+      self.discovery.cancel()
+      self.discoveryTimer.stop()
+    self.cancelLoad()
+    self.stopWatch()
+
+  def startDiscovery(self,rescanAll=False):
+    """Look for materials in a background thread - the lists fill
+    in from onDiscoveryTimer as results arrive"""
+    if self.discovery:
+      self.discovery.cancel()
+    previousStamps = None if rescanAll else self.logic.materialStamps
+    knownLabels = set(MurineTrialLib.materialLabels(self.logic.materials))
+    self.discovery = MurineTrialLib.BackgroundTask(self.logic.discoverMaterials, previousStamps, knownLabels)
+    self.discoveryProgress.value = 0
+    self.discoveryProgress.show()
+    # processing or watching a partial list of materials would be wrong
+    self.refreshButton.enabled = False
+    self.processAllButton.enabled = False
+    self.watchButton.enabled = False
+    self.discovery.start()
+    self.discoveryTimer.start()
+
+  def onRefresh(self):
+    self.startDiscovery()
+
+  def onDiscoveryTimer(self):
+    discovery = self.discovery
+    materials = self.logic.materials
+    changed = False
+    for result in discovery.results():
+      if result[0] == 'found':
+        label,material = result[1:]
+        if label not in materials:
+          self.materialsListWidget.addItem(label)
+        self.logic.addMaterial(materials, label, material)
+        changed = True
+      elif result[0] == 'missing':
+        label = result[1]
+        if label in materials:
+          self.logic.removeMaterial(materials, label)
+          for item in self.materialsListWidget.findItems(label, qt.Qt.MatchExactly):
+            self.materialsListWidget.takeItem(self.materialsListWidget.row(item))
+          changed = True
+      elif result[0] == 'progress':
+        done,total = result[1:]
+        self.discoveryProgress.maximum = max(total, 1)
+        self.discoveryProgress.value = done
+      elif result[0] == 'stamps':
+        self.logic.materialStamps = result[1]
+    if changed:
+      self.updateComparisonLists()
+    if discovery.finished():
+      self.discoveryTimer.stop()
+      self.discoveryProgress.hide()
+      self.refreshButton.enabled = True
+      self.processAllButton.enabled = True
+      self.watchButton.enabled = True
+      if discovery.error:
+        print(discovery.error)
+
+  def onWatchToggled(self,checked):
+    if checked:
+      self.logic.startWatch()
+      # the watcher owns the materials and result files while it runs
+      self.refreshButton.enabled = False
+      self.processAllButton.enabled = False
+      self.watchTimer.start()
+    elif self.watchTask:
+      # the update stops after its current unit but still writes
+      # the csv files, so wait for it in onWatchTimer
+      self.watchTask.cancel()
+      self.watchButton.enabled = False
+    else:
+      self.endWatch()
+
+  def endWatch(self):
+    self.watchTimer.stop()
+    self.refreshButton.enabled = True
+    self.processAllButton.enabled = True
+    self.watchButton.enabled = True
+
+  def stopWatch(self):
+    self.watchTimer.stop()
+    if self.watchTask:
+      self.watchTask.cancel()
+      self.watchTask = None
+
+  def onWatchTimer(self):
+    """Collect what the running update has finished; once it is done,
+    look at the files again and start an update of the units they
+    affect in the background (one update at a time)"""
+    task = self.watchTask
+    if task:
+      html = ''
+      for result in task.results():
+        if result[0] == 'updated':
+          kind,sampleID,index,side,method = result[1]
+          html += 'Updated results for %s %s %s<br>' % (sampleID, side, method or '')
+        elif result[0] == 'failed':
+          kind,sampleID,index,side,method = result[1]
+          html += 'Could not update %s %s %s: %s<br>' % (sampleID, side, method or '', result[2])
+      if html:
+        self.resultsView.setHtml(html)
+      if not task.finished():
+        return
+      if task.error:
+        print(task.error)
+      self.watchTask = None
+    if not self.watchButton.checked:
+      self.endWatch()
+      return
+    changes = self.logic.scanWatch()
+    for label in changes['added']:
+      self.materialsListWidget.addItem(label)
+    for label in changes['removed']:
+      for item in self.materialsListWidget.findItems(label, qt.Qt.MatchExactly):
+        self.materialsListWidget.takeItem(self.materialsListWidget.row(item))
+    if changes['added'] or changes['removed']:
+      self.updateComparisonLists()
+    if changes['units']:
+      self.watchTask = MurineTrialLib.BackgroundTask(self.logic.processWatchUnits, changes['units'], False)
+      self.watchTask.start()
+
+  def updateComparisonLists(self):
+    """Make the comparison and retest lists match the current materials"""
+    for listWidget,sampleIDs in (
+        (self.sampleIDsListWidget, self.logic.gigSegComparisonSampleIDs()),
+        (self.retestIDsListWidget, self.logic.retestComparisonSampleIDs()) ):
+      current = [listWidget.item(row).text() for row in range(listWidget.count)]
+      if current != sampleIDs:
+        listWidget.clear()
+        for sampleID in sampleIDs:
+          listWidget.addItem(sampleID)
+
   def updateResults(self):
     html = ''
     html += str(self.currentData)
@@ -162,20 +378,112 @@ class MurineTrialWidget:
   def onMaterialActivated(self,modelIndex):
     print('selected row %d' % modelIndex.row())
     label = modelIndex.data()
-    self.logic.loadSampleMethod(label)
-    self.resultsView.setHtml(label)
+    self.startLoad(label, [label])
 
   def onSampleIDActivated(self,modelIndex):
     print('selected row %d' % modelIndex.row())
     sampleID = modelIndex.data()
-    self.logic.loadGIGSegSample(sampleID)
-    self.resultsView.setHtml(sampleID)
+    self.startLoad(sampleID, self.logic.gigSegSampleLabels(sampleID), self.onGIGSegSampleLoaded)
 
   def onRetestActivated(self,modelIndex):
     print('selected row %d' % modelIndex.row())
     sampleID = modelIndex.data()
-    self.logic.loadRetestSample(sampleID)
-    self.resultsView.setHtml(sampleID)
+    self.startLoad(sampleID, self.logic.retestSampleLabels(sampleID))
+
+  def onGIGSegSampleLoaded(self,loadedSamples):
+    samples = {}
+    for label,nodes in loadedSamples.items():
+      samples[label.split('.')[0]] = nodes
+    self.logic.alignGIGSegSample(samples)
+
+  def startLoad(self,title,labels,onLoaded=None,preview=None,refineSamples=None):
+    """Decode the materials in the background and add their nodes
+    to the scene as they arrive.  A new load supersedes one that
+    is still in progress rather than waiting behind it.
+    With refineSamples, the full resolution data goes into those
+    (preview) nodes instead of new ones.
+    """
+    self.cancelLoad()
+    if preview is None:
+      preview = self.previewCheckBox.checked
+    self.loadTitle = title
+    self.loadOnLoaded = onLoaded
+    self.loadPreview = preview
+    self.refineSamples = refineSamples or {}
+    self.refineButton.enabled = False
+    self.loadPending = []
+    self.loadedSamples = {}
+    self.loadCount = len(labels)
+    if not self.logic.useDecodeCache:
+      self.loadWithReaders(labels)
+      return
+    self.loadTask = MurineTrialLib.BackgroundTask(self.logic.readSampleMaterials, labels, preview)
+    self.loadTask.start()
+    self.cancelLoadButton.enabled = True
+    self.resultsView.setHtml('Loading %s' % title)
+    self.loadTimer.start()
+
+  def loadWithReaders(self,labels):
+    """Without the decode cache the materials are loaded with the
+    Slicer (ITK) readers, which have to run on the GUI thread and
+    have no previews"""
+    self.loadPreview = False
+    for label in labels:
+      # full resolution replaces the preview nodes
+      for node in self.refineSamples.get(label, {}).values():
+        if slicer.mrmlScene.IsNodePresent(node):
+          slicer.mrmlScene.RemoveNode(node)
+      self.loadedSamples[label] = self.logic.loadSampleMethod(label)
+    if self.loadOnLoaded:
+      self.loadOnLoaded(self.loadedSamples)
+    self.resultsView.setHtml(self.loadTitle)
+
+  def cancelLoad(self):
+    if self.loadTask:
+      self.loadTask.cancel()
+      self.loadTask = None
+    self.loadTimer.stop()
+    self.cancelLoadButton.enabled = False
+
+  def onCancelLoad(self):
+    self.cancelLoad()
+    self.resultsView.setHtml('Cancelled loading %s' % self.loadTitle)
+
+  def onRefine(self):
+    samples = self.loadedSamples
+    self.startLoad(self.loadTitle, sorted(samples.keys()), self.loadOnLoaded, preview=False, refineSamples=samples)
+
+  def onLoadTimer(self):
+    task = self.loadTask
+    if not task:
+      return
+    self.loadPending += task.results()
+    if self.loadPending:
+      # one material per tick so the GUI stays responsive
+      label, mrArray, mrHeader, segArray, segHeader = self.loadPending.pop(0)
+      nodes = self.refineSamples.get(label)
+      if nodes:
+        self.logic.updateVolumeNode(nodes['mr'], mrArray, mrHeader, label)
+        self.logic.updateVolumeNode(nodes['seg'], segArray, segHeader, label+'-label')
+        # full resolution gets the same window/level as a direct load
+        self.logic.setSampleWindowLevel(nodes['mr'])
+      else:
+        nodes = self.logic.sampleNodesFromArrays(label, mrArray, mrHeader, segArray, segHeader, self.loadPreview)
+      self.loadedSamples[label] = nodes
+      self.resultsView.setHtml('Loading %s (%d of %d)' % (self.loadTitle, len(self.loadedSamples), self.loadCount))
+    elif task.finished():
+      self.cancelLoad()
+      if task.error:
+        print(task.error)
+        self.resultsView.setHtml('Could not load %s' % self.loadTitle)
+        return
+      if self.loadOnLoaded:
+        self.loadOnLoaded(self.loadedSamples)
+      self.refineButton.enabled = self.loadPreview
+      if self.loadPreview:
+        self.resultsView.setHtml('%s (preview)' % self.loadTitle)
+      else:
+        self.resultsView.setHtml(self.loadTitle)
 
 
   def onReload(self,moduleName="MurineTrial"):
@@ -231,7 +539,7 @@ class MurineTrialWidget:
       evalString = 'globals()["%s"].%sTest()' % (moduleName, moduleName)
       tester = eval(evalString)
       tester.runTest()
-    except Exception, e:
+    except Exception as e:
       import traceback
       traceback.print_exc()
       qt.QMessageBox.warning(slicer.util.mainWindow(),
@@ -248,7 +556,7 @@ class MurineTrialLogic:
   this class and make use of the functionality without
   requiring an instance of the Widget
   """
-  def __init__(self,dataRoot=None,resultRoot=None,experiment=None):
+  def __init__(self,dataRoot=None,resultRoot=None,experiment=None,cacheDirectory=None,collect=True):
     self.dataRoot = dataRoot
     self.resultRoot = resultRoot
     self.experiment = experiment
@@ -264,29 +572,137 @@ class MurineTrialLogic:
     self.retestMethods = ("retests", "retests-Attila")
     self.retests = ("", "-1", "-2", "-3", "-4")
 
+    self.musclesByIndex = {
+        1 : "SM",
+        2 : "RF",
+        3 : "VLI",
+        4 : "TFL",
+        5 : "SAR",
+        6 : "GRA",
+        7 : "ST",
+        8 : "BFL",
+        9 : "BFB",
+        10 : "VM",
+        11 : "ADD",
+    }
+    self.indexByMuscle = dict([(muscle,index) for index,muscle in self.musclesByIndex.items()])
+
+    # add centroid, length and surface area columns to the result files
+    self.includeMorphometrics = True
+    self.morphometricResults = {}
+
+    # bootstrap confidence intervals (fixed seed so reruns give the same csv)
+    self.bootstrapReplicates = 2000
+    self.bootstrapConfidence = 0.95
+    self.bootstrapSeed = 0
+
     if not self.dataRoot:
       self.dataRoot = "/Users/pieper/privatedata/novartis/rodents/Data Files"
     if not self.resultRoot:
       self.resultRoot = "/Users/pieper/privatedata/novartis/rodents/results"
     self.retestResultFile = os.path.join(self.resultRoot, "retestSegComparison.csv")
     self.gigResultFile = os.path.join(self.resultRoot, "gigSegComparison.csv")
+    self.strayComponentsFile = os.path.join(self.resultRoot, "strayComponents.csv")
+
+    # connected component QA of the hand-edited segmentations: stray
+    # components are reported, and left out of the volumes if useCleanedVolumes
+    self.checkComponents = True
+    self.useCleanedVolumes = False
+    self.componentResults = {}
+    self.componentReports = set()
+
+    # watch mode: how often to look for new segmentations and how long
+    # a file must stay unchanged before it is read
+    self.watchPollSeconds = 10.
+    self.watchSettleSeconds = 30.
+    self.watchSettler = None
+    self.watchRetryUnits = set()
+
+    # model maker runs to keep going at once (None for one per core)
+    self.modelConcurrency = None
+    self.modelTimeoutSeconds = 600
+
+    # decoded copies of the gzip nrrd files live on local scratch disk
+    # so repeated loads are a memory map rather than an inflate
+    self.useDecodeCache = True
+    self.decodeCache = MurineTrialLib.DecodedVolumeCache(cacheDirectory)
+
+    # without Slicer the volumes are decoded directly and nothing is displayed
+    self.useScene = slicerAvailable()
+
+    # fixed (window, level) for the mr volumes; None to use auto window/level
+    self.sampleWindowLevel = (29515, 13600)
+
+    # downsampled pyramids for quick-look browsing, kept next to the results
+    self.previewLevels = 3
+    self.previewLevel = 2
+    self.previewCache = MurineTrialLib.PreviewPyramidCache(
+        os.path.join(os.path.dirname(os.path.normpath(self.resultRoot)), "previews"))
+    # build the pyramids of all the materials at the end of processAll
+    self.buildPreviewsInBatch = True
+
+    # per-subject volume trajectories kept up to date by processAll
+    # and the watcher (see updateLongitudinal)
+    self.longitudinalMethods = self.gigSegMethods
+    self.timepointDays = None
+
+    # in batch mode a fixed set of volume nodes is refilled
+    # for each sample instead of clearing the scene
+    self.batchMode = False
+    self.nodePool = {}
+
+    # the widget discovers the materials in the background instead
+    self.materialStamps = None
+    if collect:
+      self.materials = self.collectMaterials()
+    else:
+      self.materials = self.emptyMaterials()
+    self.headerCatalog = None
+
+  def startBatch(self):
+    """Clear the scene once and then reuse the same volume
+    nodes for every sample processed until endBatch"""
+    if self.useScene:
+      slicer.mrmlScene.Clear(0)
+    self.nodePool = {}
+    self.batchMode = True
 
-    self.materials = self.collectMaterials()
+  def endBatch(self):
+    self.batchMode = False
 
   def processAll(self):
+    self.startBatch()
+    try:
+      self.processAllSamples()
+      for method in self.longitudinalMethods:
+        self.updateLongitudinal(method, self.timepointDays)
+      if self.buildPreviewsInBatch:
+        self.buildPreviews()
+    finally:
+      self.endBatch()
+
+  def processAllSamples(self):
+
+    #
+    # check the geometry of all the materials from the headers
+    # before any voxels are read
+    #
+    for issue in self.geometryInconsistencies():
+      print('geometry mismatch: {label} {field} is {value}, {reference} has {expected}'.format(**issue))
+
+    #
+    # stray components found while measuring
+    #
+    if self.checkComponents:
+      self.writeStrayComponentsHeader(self.strayComponentsFile)
+      self.componentResults = {}
+      self.componentReports = set()
+    self.morphometricResults = {}
 
     #
     # gigSEG comparision
     #
-    # initialize output file
-    fp = open(self.gigResultFile, "w")
-    headers = ["sampleID","side"] + list(self.gigSegMethods)
-    h = ''
-    for header in headers:
-      h += header+', '
-    h = h[0:-2]+'\n'
-    fp.write(h)
-    fp.close()
+    self.writeGIGSegResultHeader()
 
     # write a line per calf
     for gigSegSampleID in self.gigSegComparisonSampleIDs():
@@ -297,9 +713,35 @@ class MurineTrialLogic:
     #
     # retest comparision
     #
-    # initialize output file
+    self.writeRetestResultHeader()
+
+    # write a line per calf
+    for retestSampleID in self.retestComparisonSampleIDs():
+      for index,side in ( (1,'right'), (2,'left') ):
+        for method in self.retestMethods:
+          self.delayDisplay('processing {} {} side {}'.format(retestSampleID,side,method), 500)
+          self.processRetestSample(retestSampleID,index,side,method)
+
+  def writeGIGSegResultHeader(self):
+    """initialize the gigSeg comparison output file"""
+    fp = open(self.gigResultFile, "w")
+    headers = ["sampleID","side"] + list(self.gigSegMethods)
+    if self.includeMorphometrics:
+      headers += self.morphometricHeaders(self.gigSegMethods)
+    h = ''
+    for header in headers:
+      h += header+', '
+    h = h[0:-2]+'\n'
+    fp.write(h)
+    fp.close()
+
+  def writeRetestResultHeader(self):
+    """initialize the retest comparison output file"""
     fp = open(self.retestResultFile, "w")
     headers = ["sampleID","side","method"] + list(self.retests)
+    headers += ["mean", "ci low", "ci high"]
+    if self.includeMorphometrics:
+      headers += self.morphometricHeaders(['retest'+retest for retest in self.retests])
     h = ''
     for header in headers:
       h += header+', '
@@ -307,45 +749,189 @@ class MurineTrialLogic:
     fp.write(h)
     fp.close()
 
-    # write a line per calf
-    for retestSampleID in self.retestComparisonSampleIDs():
-      for index,side in ( (1,'right'), (2,'left') ):
-        for method in self.retestMethods:
-          self.delayDisplay('processing {} {} side {}'.format(retestSampleID,side,method), 500)
-          self.processRetestSample(retestSampleID,index,side,method)
+  def gigSegSampleLabels(self,sampleID):
+    return [method + '.' + sampleID for method in self.gigSegMethods]
 
   def loadGIGSegSample(self,sampleID):
     samples = {}
     for method in self.gigSegMethods:
       label = method + '.' + sampleID
       samples[method] = self.loadSampleMethod(label)
+    self.alignGIGSegSample(samples)
+    return samples
+
+  def alignGIGSegSample(self,samples):
+    """the GIGseg analyze files have no usable orientation,
+    so give them the geometry of the Slicer-seg volumes"""
     ijkToRAS = vtk.vtkMatrix4x4()
     samples['Slicer-seg']['mr'].GetIJKToRASMatrix(ijkToRAS)
     samples['Novartis-GIGseg']['mr'].SetIJKToRASMatrix(ijkToRAS)
     samples['Novartis-GIGseg']['seg'].SetIJKToRASMatrix(ijkToRAS)
-    return samples
 
-  def processGIGSegSample(self,sampleID,index,side,appendCSV=True):
-    slicer.mrmlScene.Clear(0)
-    samples = {}
+  def processGIGSegSample(self,sampleID,index,side,appendCSV=True,inScene=True):
+    if self.useScene and inScene and not self.batchMode:
+      slicer.mrmlScene.Clear(0)
     row = sampleID + ", " + side + ", "
+    shapeRow = ""
     for method in self.gigSegMethods:
       indexToUse = index
-      if method == 'Novartis-GIGseg' and self.gigRemaps.has_key(sampleID):
+      if method == 'Novartis-GIGseg' and sampleID in self.gigRemaps:
         indexToUse = self.gigRemaps[sampleID][index-1][0]
       label = method + '.' + sampleID
-      samples[method] = self.loadSampleMethod(label)
-      pixelVolumeMM = numpy.array(samples[method]['seg'].GetSpacing()).prod()
-      a = slicer.util.array(samples[method]['seg'].GetID())
-      a[a != indexToUse] = 0
-      a[a == indexToUse] = 1
-      volume = pixelVolumeMM * a.sum()
+      labelArray,spacing,ijkToRAS = self.sampleLabelArray(label, slot=method, inScene=inScene)
+      if self.includeMorphometrics:
+        shapeRow += self.morphometricCells(label, labelArray, ijkToRAS, indexToUse)
+      volume = self.labelArrayVolume(label, labelArray, spacing, ijkToRAS, indexToUse)
       row += str(volume)+", "
-    row = row[0:-2]+"\n"
-    fp = open(self.gigResultFile, "a")
-    fp.write(row)
+    row = (row+shapeRow)[0:-2]+"\n"
+    if appendCSV:
+      fp = open(self.gigResultFile, "a")
+      fp.write(row)
+      fp.close()
+    return row
+
+  def componentQAMethod(self,method):
+    """True for the methods that are edited by hand"""
+    return method.startswith('Slicer-seg-corr') or method in self.retestMethods
+
+  def sharedSegLabel(self,label):
+    """True for the first ("") retest of a retest method, whose seg is
+    the file of a Slicer-seg-corr method and is reported under that"""
+    material = self.materials[label]
+    return material['method'] in self.retestMethods and material['retest'] == ''
+
+  def labelArrayVolume(self,label,labelArray,spacing,ijkToRAS,index):
+    """Volume in mm3 of one label of a material.  For the hand-edited
+    methods the stray components of every label are found in one pass
+    (and kept, by seg file, for the other side of the sample and for
+    the retests that share the seg) and written to the
+    strayComponentsFile in place of the material's earlier lines; with
+    useCleanedVolumes only the main component of the label is counted."""
+    method = label.partition('.')[0]
+    if not (self.checkComponents and self.componentQAMethod(method)):
+      return MurineTrialLib.labelVolume(labelArray, spacing, index)
+    segPath = self.materials[label]['segPath']
+    key = (segPath, os.path.getmtime(segPath))
+    components = self.componentResults.get(key)
+    if components is None:
+      components = MurineTrialLib.strayComponents(labelArray, ijkToRAS)
+      self.componentResults[key] = components
+    if (label,) + key not in self.componentReports and not self.sharedSegLabel(label):
+      self.componentReports.add((label,) + key)
+      self.writeStrayComponents(self.strayComponentsFile, label, components)
+    if not self.useCleanedVolumes:
+      return MurineTrialLib.labelVolume(labelArray, spacing, index)
+    if index not in components:
+      return 0.
+    return numpy.array(spacing, dtype='float64').prod() * components[index]['mainVoxels']
+
+  def writeStrayComponentsHeader(self,filePath):
+    fp = open(filePath, "w")
+    fp.write("label, index, components, voxels, strayVoxels, cleanedVolumeMM3, strayVoxelCount, i, j, k, R, A, S\n")
     fp.close()
 
+  def writeStrayComponents(self,filePath,label,components):
+    """one line per stray component of each label value, in place of
+    the lines the material had before (components None drops them)"""
+    if not os.path.exists(filePath):
+      self.writeStrayComponentsHeader(filePath)
+    lines = []
+    for index in sorted((components or {}).keys()):
+      result = components[index]
+      for stray in result['strays']:
+        values = [label, index, result['components'], result['voxels'], result['strayVoxels'],
+                  result['cleanedVolumeMM3'], stray['voxels']]
+        values += list(stray['ijk']) + list(stray['centroid'])
+        lines.append(", ".join([str(value) for value in values]))
+    MurineTrialLib.replaceCSVRows(filePath, {(label,): "\n".join(lines) or None}, 1)
+
+  def componentQA(self,filePath=None):
+    """Report the stray components of all the hand-edited
+    segmentations.  Returns {label: MurineTrialLib.strayComponents}
+    for the materials that have any."""
+    if not filePath:
+      filePath = self.strayComponentsFile
+    self.writeStrayComponentsHeader(filePath)
+    report = {}
+    for label in sorted(MurineTrialLib.materialLabels(self.materials)):
+      material = self.materials[label]
+      if not self.componentQAMethod(material['method']) or self.sharedSegLabel(label):
+        continue
+      labelArray,header = self.readVolume(material['segPath'])
+      components = MurineTrialLib.strayComponents(labelArray, MurineTrialLib.headerIJKToRAS(header))
+      self.writeStrayComponents(filePath, label, components)
+      if [index for index in components if components[index]['strays']]:
+        report[label] = components
+    return report
+
+  def removeStrayVoxels(self,labelNode):
+    """Keep only the largest component of each label of a label volume node"""
+    labelArray = slicer.util.array(labelNode.GetID())
+    labelArray[:] = MurineTrialLib.removeStrayComponents(labelArray)
+    labelNode.GetImageData().Modified()
+
+  def morphometricHeaders(self,prefixes):
+    headers = []
+    for prefix in prefixes:
+      for column in MurineTrialLib.morphometricColumns:
+        headers.append(prefix + ' ' + column)
+    return headers
+
+  def sampleLabelArray(self,label,slot=None,inScene=True):
+    """The seg of a material as (array, spacing, ijkToRAS).
+    In Slicer it is loaded into the scene (reusing the slot nodes in
+    batch mode) so it can be looked at; otherwise, or with inScene
+    False, it is just decoded."""
+    if self.useScene and inScene:
+      labelNode = self.loadSampleMethod(label, slot=slot)['seg']
+      return slicer.util.array(labelNode.GetID()), labelNode.GetSpacing(), self.nodeIJKToRAS(labelNode)
+    labelArray,header = self.readVolume(self.materials[label]['segPath'])
+    return labelArray, header['spacing'], MurineTrialLib.headerIJKToRAS(header)
+
+  def nodeIJKToRAS(self,volumeNode):
+    matrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(matrix)
+    return [[matrix.GetElement(row,column) for column in range(4)] for row in range(4)]
+
+  def labelArrayMorphometrics(self,label,labelArray,ijkToRAS,labels=None):
+    """MurineTrialLib.labelMorphometrics of a material's label array.
+    The GIGseg volumes are measured in the Slicer-seg geometry
+    of the same sample, like alignGIGSegSample does for display."""
+    method,dot,sampleID = label.partition('.')
+    referenceLabel = 'Slicer-seg.' + sampleID
+    if method == 'Novartis-GIGseg' and referenceLabel in self.materials:
+      header = MurineTrialLib.readHeader(self.materials[referenceLabel]['segPath'])
+      ijkToRAS = MurineTrialLib.headerIJKToRAS(header)
+    return MurineTrialLib.labelMorphometrics(labelArray, ijkToRAS, labels=labels)
+
+  def labelNodeMorphometrics(self,label,labelNode,labels=None):
+    """labelArrayMorphometrics of a label volume node"""
+    labelArray = slicer.util.array(labelNode.GetID())
+    return self.labelArrayMorphometrics(label, labelArray, self.nodeIJKToRAS(labelNode), labels)
+
+  def morphometricCells(self,label,labelArray,ijkToRAS,index):
+    """csv cells for the morphometricColumns of one label.
+    All the muscle labels of the material are measured in one pass
+    and kept for the other side of the sample."""
+    key = (label, os.path.getmtime(self.materials[label]['segPath']))
+    results = self.morphometricResults.get(key)
+    if results is None or index not in results:
+      labels = sorted(set(self.musclesByIndex.keys()) | set([index]))
+      results = self.labelArrayMorphometrics(label, labelArray, ijkToRAS, labels)
+      self.morphometricResults[key] = results
+    result = results[index]
+    cells = ''
+    for value in MurineTrialLib.morphometricValues(result):
+      cells += str(value)+", "
+    return cells
+
+  def retestSampleLabels(self,sampleID):
+    labels = []
+    for method in self.retestMethods:
+      for retest in self.retests:
+        labels.append(method + '.' + sampleID + retest)
+    return labels
+
   def loadRetestSample(self,sampleID):
     samples = {}
     for method in self.retestMethods:
@@ -354,23 +940,29 @@ class MurineTrialLogic:
         samples[retest] = self.loadSampleMethod(label)
     return samples
 
-  def processRetestSample(self,sampleID,index,side,method):
-    slicer.mrmlScene.Clear(0)
-    samples = {}
+  def processRetestSample(self,sampleID,index,side,method,appendCSV=True,inScene=True):
+    if self.useScene and inScene and not self.batchMode:
+      slicer.mrmlScene.Clear(0)
     row = sampleID + ", " + side + ", " + method + ", "
+    shapeRow = ""
+    volumes = []
     for retest in self.retests:
       label = method + '.' + sampleID + retest
-      samples[retest] = self.loadSampleMethod(label)
-      pixelVolumeMM = numpy.array(samples[retest]['seg'].GetSpacing()).prod()
-      a = slicer.util.array(samples[retest]['seg'].GetID())
-      a[a != index] = 0
-      a[a == index] = 1
-      volume = pixelVolumeMM * a.sum()
+      labelArray,spacing,ijkToRAS = self.sampleLabelArray(label, slot='retest'+retest, inScene=inScene)
+      if self.includeMorphometrics:
+        shapeRow += self.morphometricCells(label, labelArray, ijkToRAS, index)
+      volume = self.labelArrayVolume(label, labelArray, spacing, ijkToRAS, index)
+      volumes.append(volume)
       row += str(volume)+", "
-    row = row[0:-2]+"\n"
-    fp = open(self.retestResultFile, "a")
-    fp.write(row)
-    fp.close()
+    # repeatability: interval of the mean volume over the repeats
+    for value in MurineTrialLib.bootstrapMean(volumes, self.bootstrapReplicates, self.bootstrapConfidence, self.bootstrapSeed):
+      row += str(value)+", "
+    row = (row+shapeRow)[0:-2]+"\n"
+    if appendCSV:
+      fp = open(self.retestResultFile, "a")
+      fp.write(row)
+      fp.close()
+    return row
 
   def gigSegComparisonSampleIDs(self):
     '''Compare Novartis GIGseg segmentations to Slicer segmentations'''
@@ -381,7 +973,7 @@ class MurineTrialLogic:
       allMethodsAvalable = True
       for method in self.gigSegMethods:
         label = method + '.' + sampleID
-        allMethodsAvalable = allMethodsAvalable and self.materials.has_key(label)
+        allMethodsAvalable = allMethodsAvalable and label in self.materials
       if allMethodsAvalable:
         gigSegSampleIDs.append(sampleID)
     return gigSegSampleIDs
@@ -396,24 +988,213 @@ class MurineTrialLogic:
         allTestsAvalable = True
         for retest in self.retests:
           label = method + '.' + sampleID + retest
-          allTestsAvalable = allTestsAvalable and self.materials.has_key(label)
+          allTestsAvalable = allTestsAvalable and label in self.materials
         if allTestsAvalable:
           retestSampleIDs.append(sampleID)
     return retestSampleIDs
 
-  def loadSampleMethod(self,label):
+  def loadSampleMethod(self,label,slot=None):
+    """Load the mr and seg of a material into the scene.
+    In batch mode the nodes of the given slot are reused (or,
+    without the decode cache, replaced) so the scene does not grow."""
     material = self.materials[label]
+    if self.useDecodeCache:
+      (mrArray,mrHeader),(segArray,segHeader) = self.readVolumes((material['mrPath'], material['segPath']))
+      if self.batchMode and slot is not None:
+        return self.pooledSampleNodes(slot, label, mrArray, mrHeader, segArray, segHeader)
+      return self.sampleNodesFromArrays(label, mrArray, mrHeader, segArray, segHeader)
+    if self.batchMode and slot is not None:
+      # loadVolume always makes new nodes, so drop the ones the slot had
+      for node in self.nodePool.pop(slot, {}).values():
+        if slicer.mrmlScene.IsNodePresent(node):
+          slicer.mrmlScene.RemoveNode(node)
     result,volumeNode = slicer.util.loadVolume(material['mrPath'], returnNode=True)
     volumeNode.SetName(label)
     if result:
-      displayNode = volumeNode.GetDisplayNode()
-      displayNode.SetAutoWindowLevel(False)
-      displayNode.SetWindow(29515)
-      displayNode.SetLevel(13600)
+      self.setSampleWindowLevel(volumeNode)
     labelResult,labelVolumeNode = slicer.util.loadVolume(material['segPath'], {'labelmap': True}, returnNode=True)
     labelVolumeNode.SetName(label+'-label')
+    nodes = {'mr': volumeNode, 'seg': labelVolumeNode}
+    if self.batchMode and slot is not None:
+      self.nodePool[slot] = nodes
+    return nodes
+
+  def sampleNodesFromArrays(self,label,mrArray,mrHeader,segArray,segHeader,preview=False):
+    """scene nodes for a material from already decoded arrays
+    (previews keep auto window/level since their intensities are averaged)"""
+    volumeNode = self.volumeNodeFromArray(mrArray, mrHeader, label)
+    if not preview:
+      self.setSampleWindowLevel(volumeNode)
+    labelVolumeNode = self.volumeNodeFromArray(segArray, segHeader, label+'-label', labelMap=True)
     return {'mr': volumeNode, 'seg': labelVolumeNode}
 
+  def pooledSampleNodes(self,slot,label,mrArray,mrHeader,segArray,segHeader):
+    """Refill the volume nodes kept for the slot with new data,
+    making them the first time the slot is used"""
+    nodes = self.nodePool.get(slot)
+    if not nodes or not slicer.mrmlScene.IsNodePresent(nodes['mr']) \
+                 or not slicer.mrmlScene.IsNodePresent(nodes['seg']):
+      nodes = self.sampleNodesFromArrays(label, mrArray, mrHeader, segArray, segHeader)
+      self.nodePool[slot] = nodes
+      return nodes
+    self.updateVolumeNode(nodes['mr'], mrArray, mrHeader, label)
+    self.updateVolumeNode(nodes['seg'], segArray, segHeader, label+'-label')
+    return nodes
+
+  def setSampleWindowLevel(self,volumeNode):
+    if not self.sampleWindowLevel:
+      return
+    window,level = self.sampleWindowLevel
+    displayNode = volumeNode.GetDisplayNode()
+    displayNode.SetAutoWindowLevel(False)
+    displayNode.SetWindow(window)
+    displayNode.SetLevel(level)
+
+  def readSampleMaterials(self,task,labels,preview=False):
+    """Decode the mr and seg of each material label from a
+    MurineTrialLib.BackgroundTask, posting
+    (label, mrArray, mrHeader, segArray, segHeader) for each one.
+    With preview, the arrays are the downsampled previewLevel.
+    Scene nodes must be made on the GUI thread with sampleNodesFromArrays.
+    """
+    for label in labels:
+      if task.cancelled():
+        return
+      material = self.materials[label]
+      if preview:
+        mrArray,mrHeader = self.readPreviewVolume(material['mrPath'])
+        segArray,segHeader = self.readPreviewVolume(material['segPath'], labelMap=True)
+      else:
+        (mrArray,mrHeader),(segArray,segHeader) = self.readVolumes((material['mrPath'], material['segPath']))
+      task.post((label, mrArray, mrHeader, segArray, segHeader))
+
+  def readPreviewVolume(self,path,labelMap=False,level=None):
+    """(array, header) of a downsampled version of the volume: block
+    averages for mr, block modes for labels.  The pyramid is built
+    and cached the first time; measurements always use readVolume."""
+    level = level or self.previewLevel
+    header = MurineTrialLib.readHeader(path)
+    cached = self.previewCache.get(header, level)
+    if cached:
+      return cached
+    array,header = self.readVolume(path)
+    pyramid = MurineTrialLib.buildPyramid(array, header, self.previewLevels, labelMap)
+    if not pyramid:
+      return array,header
+    try:
+      self.previewCache.put(header, pyramid)
+    except (IOError, OSError) as e:
+      print('Could not cache preview of %s: %s' % (path, e))
+    return pyramid[min(level, len(pyramid)) - 1]
+
+  def buildPreviews(self,labels=None):
+    """Make the preview pyramids of the mr and seg of the materials
+    (default all) that do not have one yet, so the first quick-look
+    of a material does not have to decode the full volume.
+    Returns the paths whose pyramids were built."""
+    if labels is None:
+      labels = MurineTrialLib.materialLabels(self.materials)
+    built = []
+    seen = set()
+    for label in labels:
+      material = self.materials[label]
+      for path,labelMap in ((material['mrPath'], False), (material['segPath'], True)):
+        if path in seen:
+          continue
+        seen.add(path)
+        if self.previewCache.get(MurineTrialLib.readHeader(path), 1) is None:
+          self.delayDisplay('building preview of {}'.format(path), 100)
+          self.readPreviewVolume(path, labelMap)
+          built.append(path)
+    return built
+
+  def readVolume(self,path):
+    """Decoded (array,header) for a volume file, via the decode cache"""
+    return MurineTrialLib.readVolume(path, self.decodeCache)
+
+  def readVolumes(self,paths):
+    """Decode several volume files in parallel, via the decode cache"""
+    return MurineTrialLib.readVolumes(list(paths), self.decodeCache)
+
+  def imageDataFromArray(self,array,header):
+    """vtkImageData holding a copy of the array"""
+    from vtk.util import numpy_support
+    array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('='))
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(*header['dimensions'])
+    components = header['components']
+    scalars = numpy_support.numpy_to_vtk(array.reshape(-1, components) if components > 1 else array.ravel(), deep=True)
+    imageData.GetPointData().SetScalars(scalars)
+    return imageData
+
+  def ijkToRASMatrix(self,header):
+    ijkToRASElements = MurineTrialLib.headerIJKToRAS(header)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        ijkToRAS.SetElement(row, column, ijkToRASElements[row][column])
+    return ijkToRAS
+
+  def volumeNodeFromArray(self,array,header,name,labelMap=False):
+    """Add a volume node to the scene holding a copy of the
+    array, with the spacing and orientation from the header"""
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName(name)
+    volumeNode.SetLabelMap(labelMap)
+    volumeNode.SetAndObserveImageData(self.imageDataFromArray(array, header))
+    volumeNode.SetIJKToRASMatrix(self.ijkToRASMatrix(header))
+    slicer.mrmlScene.AddNode(volumeNode)
+    self.setVolumeStorage(volumeNode, header)
+
+    if labelMap:
+      displayNode = slicer.vtkMRMLLabelMapVolumeDisplayNode()
+      colorNodeID = 'vtkMRMLColorTableNodeLabels'
+    else:
+      displayNode = slicer.vtkMRMLScalarVolumeDisplayNode()
+      colorNodeID = 'vtkMRMLColorTableNodeGrey'
+    slicer.mrmlScene.AddNode(displayNode)
+    displayNode.SetAndObserveColorNodeID(colorNodeID)
+    volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+    return volumeNode
+
+  def updateVolumeNode(self,volumeNode,array,header,name):
+    """Put new voxels and geometry into an existing volume node.
+    When the size and type match, the voxels are copied into the
+    existing image data so no new vtk objects are made; all the
+    changes are sent as a single modified event."""
+    from vtk.util import numpy_support
+    wasModifying = volumeNode.StartModify()
+    volumeNode.SetName(name)
+    volumeNode.SetIJKToRASMatrix(self.ijkToRASMatrix(header))
+    imageData = volumeNode.GetImageData()
+    scalars = imageData.GetPointData().GetScalars() if imageData else None
+    target = numpy_support.vtk_to_numpy(scalars) if scalars else None
+    if target is not None and tuple(imageData.GetDimensions()) == tuple(header['dimensions']) \
+        and target.dtype == array.dtype.newbyteorder('=') and target.size == array.size:
+      target.reshape(array.shape)[:] = array
+      scalars.Modified()
+      imageData.Modified()
+    else:
+      volumeNode.SetAndObserveImageData(self.imageDataFromArray(array, header))
+    self.setVolumeStorage(volumeNode, header)
+    volumeNode.EndModify(wasModifying)
+
+  def setVolumeStorage(self,volumeNode,header):
+    """Point the node's archetype storage node at the file the voxels
+    were read from, like slicer.util.loadVolume does, so an edited
+    segmentation is saved back over its source.  Previews get none so
+    a downsampled volume is never saved over the full one."""
+    storageNode = volumeNode.GetStorageNode()
+    if 'previewFactors' in header:
+      if storageNode:
+        volumeNode.SetAndObserveStorageNodeID(None)
+      return
+    if not storageNode:
+      storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+      slicer.mrmlScene.AddNode(storageNode)
+      volumeNode.SetAndObserveStorageNodeID(storageNode.GetID())
+    storageNode.SetFileName(header['path'])
+
 
   # HACK: duplicated from testing - should be cleaned up really...
   def delayDisplay(self,message,msec=1000):
@@ -425,6 +1206,8 @@ class MurineTrialLogic:
     so that we'll know when it breaks.
     """
     print(message)
+    if not self.useScene:
+      return
     self.info = qt.QDialog()
     self.infoLayout = qt.QVBoxLayout()
     self.info.setLayout(self.infoLayout)
@@ -433,8 +1216,9 @@ class MurineTrialLogic:
     qt.QTimer.singleShot(msec, self.info.close)
     self.info.exec_()
 
-  def collectMaterials(self):
-    """get the list of available data from the files"""
+  def materialCandidates(self):
+    """every (label, material) allowed by the file naming conventions,
+    whether or not the files exist"""
 
     species = ('mouse', 'rat')
     subjects = range(1,19)
@@ -442,11 +1226,6 @@ class MurineTrialLogic:
     methods = ("Novartis-GIGseg", "Slicer-seg", "Slicer-seg-corr", "Slicer-seg-corr-Novartis", "Slicer-seg-corr-2", "retests", "retests-Attila")
     methods = self.gigSegMethods + self.retestMethods
 
-    keys = {"species", "subjects", "times", "methods", "retests", "sampleIDs"}
-    materials = {}
-    for key in keys:
-      materials[key] = set()
-
     for specie in species:
       for subject in subjects:
         for time in times:
@@ -472,35 +1251,373 @@ class MurineTrialLogic:
               else:
                 material['mrPath'] = os.path.join(self.dataRoot,method,sampleID+".nrrd")
                 material['segPath'] = os.path.join(self.dataRoot,method,sampleID+"-label.nrrd")
-              # add an entry to the materials
-              if os.path.exists(material['mrPath']) and os.path.exists(material['segPath']):
-                materials['species'].add(specie)
-                materials['subjects'].add(subject)
-                materials['times'].add(time)
-                materials['methods'].add(method)
-                materials['retests'].add(retest)
-                materials['sampleIDs'].add(sampleID)
-                label = method + '.' + sampleID + labelSuffix
-                materials[label] = material
+              material['specie'] = specie
+              material['subject'] = subject
+              material['time'] = time
+              material['method'] = method
+              material['retest'] = retest
+              material['sampleID'] = sampleID
+              label = method + '.' + sampleID + labelSuffix
+              yield label, material
+
+  def materialDirectories(self):
+    """the directories that hold materials"""
+    directories = [self.dataRoot]
+    for method in self.gigSegMethods + self.retestMethods:
+      if method != "Novartis-GIGseg":
+        directories.append(os.path.join(self.dataRoot,method))
+    return [os.path.normpath(directory) for directory in directories]
+
+  def materialStampsNow(self):
+    """modification times of the material directories - these
+    change whenever a file is added to or removed from them"""
+    stamps = {}
+    for directory in self.materialDirectories():
+      try:
+        stamps[directory] = os.stat(directory).st_mtime
+      except OSError:
+        stamps[directory] = None
+    return stamps
+
+  def materialExists(self,material,listings):
+    """check the material files against directory listings,
+    listing each directory only once (much faster than os.path.exists
+    for the thousands of candidates)"""
+    for pathKey in ('mrPath', 'segPath'):
+      directory,fileName = os.path.split(os.path.normpath(material[pathKey]))
+      if directory not in listings:
+        try:
+          listings[directory] = set(os.listdir(directory))
+        except OSError:
+          listings[directory] = set()
+      if fileName not in listings[directory]:
+        return False
+    return True
+
+  def emptyMaterials(self):
+    materials = {}
+    for key in ("species", "subjects", "times", "methods", "retests", "sampleIDs"):
+      materials[key] = set()
+    return materials
+
+  def addMaterial(self,materials,label,material):
+    self.summarizeMaterial(materials, material)
+    materials[label] = material
+    self.headerCatalog = None
+
+  def removeMaterial(self,materials,label):
+    del materials[label]
+    for key in self.emptyMaterials().keys():
+      materials[key].clear()
+    for remainingLabel in MurineTrialLib.materialLabels(materials):
+      self.summarizeMaterial(materials, materials[remainingLabel])
+    self.headerCatalog = None
+
+  def summarizeMaterial(self,materials,material):
+    """add the material to the species, subjects, ... sets"""
+    materials['species'].add(material['specie'])
+    materials['subjects'].add(material['subject'])
+    materials['times'].add(material['time'])
+    materials['methods'].add(material['method'])
+    materials['retests'].add(material['retest'])
+    materials['sampleIDs'].add(material['sampleID'])
+
+  def collectMaterials(self):
+    """get the list of available data from the files"""
+    materials = self.emptyMaterials()
+    listings = {}
+    for label,material in self.materialCandidates():
+      # add an entry to the materials
+      if self.materialExists(material, listings):
+        self.addMaterial(materials, label, material)
+    self.materialStamps = self.materialStampsNow()
     return(materials)
 
+  def discoverMaterials(self,task,previousStamps=None,knownLabels=()):
+    """Find materials from a MurineTrialLib.BackgroundTask.
+    Posts ('found', label, material) for each material and
+    ('progress', done, total) as it goes, then ('stamps', stamps).
+    With previousStamps, only the directories that changed since
+    are re-scanned and ('missing', label) is posted for knownLabels
+    whose files are gone.
+    """
+    stamps = self.materialStampsNow()
+    changed = set()
+    for directory in stamps.keys():
+      if previousStamps is None or previousStamps.get(directory) != stamps[directory]:
+        changed.add(directory)
+    candidates = []
+    seen = set()
+    for label,material in self.materialCandidates():
+      directories = [os.path.dirname(os.path.normpath(material[k])) for k in ('mrPath', 'segPath')]
+      if label not in seen and changed.intersection(directories):
+        candidates.append((label,material))
+        seen.add(label)
+    listings = {}
+    total = len(candidates)
+    for done,(label,material) in enumerate(candidates):
+      if task.cancelled():
+        return
+      if self.materialExists(material, listings):
+        task.post(('found', label, material))
+      elif label in knownLabels:
+        task.post(('missing', label))
+      if done % 200 == 0:
+        task.post(('progress', done, total))
+    task.post(('progress', total, total))
+    task.post(('stamps', stamps))
+
+  def materialUnits(self,label):
+    """The result csv rows a material is part of, as
+    (kind, sampleID, index, side, method) with kind 'gig' or 'retest'"""
+    material = self.materials[label]
+    method,sampleID = material['method'],material['sampleID']
+    units = []
+    for index,side in ( (1,'right'), (2,'left') ):
+      if method in self.gigSegMethods and label == method + '.' + sampleID:
+        units.append(('gig', sampleID, index, side, None))
+      if method in self.retestMethods:
+        units.append(('retest', sampleID, index, side, method))
+    return units
+
+  def unitLabels(self,unit):
+    """The material labels that a result csv row is made from"""
+    kind,sampleID,index,side,method = unit
+    if kind == 'gig':
+      return self.gigSegSampleLabels(sampleID)
+    return [method + '.' + sampleID + retest for retest in self.retests]
+
+  def unitSettling(self,unit,found):
+    """True if a file of the unit's materials is still being written"""
+    for label in self.unitLabels(unit):
+      material = found.get(label)
+      if material and (material['mrPath'] in self.watchSettler.pending or
+                       material['segPath'] in self.watchSettler.pending):
+        return True
+    return False
+
+  def startWatch(self):
+    """Take the current materials as processed and start looking
+    for changes with pollWatch"""
+    self.watchSettler = MurineTrialLib.FileSettler(self.watchSettleSeconds)
+    self.watchRetryUnits = set()
+    paths = []
+    for label in MurineTrialLib.materialLabels(self.materials):
+      paths += [self.materials[label]['mrPath'], self.materials[label]['segPath']]
+    self.watchSettler.prime(paths)
+    if not os.path.exists(self.gigResultFile):
+      self.writeGIGSegResultHeader()
+    if not os.path.exists(self.retestResultFile):
+      self.writeRetestResultHeader()
+    if self.checkComponents and not os.path.exists(self.strayComponentsFile):
+      self.writeStrayComponentsHeader(self.strayComponentsFile)
+
+  def pollWatch(self):
+    """Look once for materials that are new, rewritten or gone
+    (using the collectMaterials naming rules) and redo just the
+    (sample, side, method) rows of the result csv files they are part
+    of, in place.  Files are only read once they have settled.
+    A unit that fails, or has files still being written, is tried
+    again on a later poll.
+    Returns {'added': labels, 'removed': labels, 'updated': units,
+    'failed': units}.
+    """
+    changes = self.scanWatch()
+    changes.update(self.processWatchUnits(None, changes['units']))
+    return changes
+
+  def scanWatch(self):
+    """The file side of pollWatch: bring the materials up to date
+    with the settled files.  Returns {'added': labels, 'removed':
+    labels, 'units': units} with the units to redo, for
+    processWatchUnits."""
+    if not self.watchSettler:
+      self.startWatch()
+    found = {}
+    listings = {}
+    for label,material in self.materialCandidates():
+      if label not in found and self.materialExists(material, listings):
+        found[label] = material
+    pathLabels = {}
+    for label,material in found.items():
+      for pathKey in ('mrPath', 'segPath'):
+        pathLabels.setdefault(material[pathKey], set()).add(label)
+    settled,removedPaths = self.watchSettler.poll(pathLabels.keys())
+
+    units = set(self.watchRetryUnits)
+    self.watchRetryUnits = set()
+    removed = []
+    for label in sorted(MurineTrialLib.materialLabels(self.materials)):
+      if label not in found:
+        units.update(self.materialUnits(label))
+        self.removeMaterial(self.materials, label)
+        if self.checkComponents and self.componentQAMethod(label.partition('.')[0]):
+          self.writeStrayComponents(self.strayComponentsFile, label, None)
+        removed.append(label)
+    added = []
+    for path in settled:
+      for label in sorted(pathLabels[path]):
+        # wait until every file of the material has settled
+        material = found[label]
+        if material['mrPath'] in self.watchSettler.pending or material['segPath'] in self.watchSettler.pending:
+          continue
+        if label not in self.materials:
+          self.addMaterial(self.materials, label, found[label])
+          added.append(label)
+        units.update(self.materialUnits(label))
+    ready = []
+    for unit in sorted(units):
+      if self.unitSettling(unit, found):
+        self.watchRetryUnits.add(unit)
+      else:
+        ready.append(unit)
+    return {'added': added, 'removed': removed, 'units': ready}
+
+  def processWatchUnits(self,task,units,inScene=True):
+    """Redo the result csv rows of the units from scanWatch.
+    Can run from a MurineTrialLib.BackgroundTask (with inScene False,
+    so the scene is left alone), posting ('updated', unit) and
+    ('failed', unit, message) once the csv files (and the
+    longitudinalMethods trajectories) are written; units
+    that fail or are not reached before a cancel are kept for the
+    next scan.  Returns {'updated': units, 'failed': units}."""
+    # rows of units that are no longer complete are dropped
+    gigRows = {}
+    retestRows = {}
+    updated = []
+    failed = []
+    messages = {}
+    wasBatchMode = self.batchMode
+    if inScene:
+      self.batchMode = True
+    try:
+      for position,unit in enumerate(units):
+        if task and task.cancelled():
+          self.watchRetryUnits.update(units[position:])
+          break
+        kind,sampleID,index,side,method = unit
+        complete = not [label for label in self.unitLabels(unit) if label not in self.materials]
+        try:
+          row = None
+          if kind == 'gig':
+            if complete:
+              row = self.processGIGSegSample(sampleID, index, side, appendCSV=False, inScene=inScene)
+          else:
+            if complete:
+              row = self.processRetestSample(sampleID, index, side, method, appendCSV=False, inScene=inScene)
+        except Exception as e:
+          print('Could not process %s %s %s %s, will retry: %s' % (kind, sampleID, side, method or '', e))
+          failed.append(unit)
+          messages[unit] = str(e)
+          continue
+        if kind == 'gig':
+          gigRows[(sampleID, side)] = row
+        else:
+          retestRows[(sampleID, side, method)] = row
+        updated.append(unit)
+    finally:
+      self.batchMode = wasBatchMode
+    self.watchRetryUnits.update(failed)
+    if gigRows:
+      MurineTrialLib.replaceCSVRows(self.gigResultFile, gigRows, 2)
+    if retestRows:
+      MurineTrialLib.replaceCSVRows(self.retestResultFile, retestRows, 3)
+    # the trajectories of the methods whose materials changed
+    methods = set()
+    for unit in updated:
+      methods.update([label.partition('.')[0] for label in self.unitLabels(unit)])
+    for method in self.longitudinalMethods:
+      if method in methods:
+        try:
+          self.updateLongitudinal(method, self.timepointDays)
+        except Exception as e:
+          print('Could not update the %s trajectories: %s' % (method, e))
+    if task:
+      for unit in updated:
+        task.post(('updated', unit))
+      for unit in failed:
+        task.post(('failed', unit, messages[unit]))
+    return {'updated': updated, 'failed': failed}
+
+  def watch(self,iterations=None):
+    """Keep the result csv files up to date as segmentations
+    arrive (blocks; for running without the module GUI)"""
+    import time
+    self.startWatch()
+    count = 0
+    while iterations is None or count < iterations:
+      time.sleep(self.watchPollSeconds)
+      count += 1
+      try:
+        changes = self.pollWatch()
+      except Exception:
+        # keep watching; the next poll starts over from the files
+        import traceback
+        traceback.print_exc()
+        continue
+      for label in changes['added']:
+        print('new material %s' % label)
+      for label in changes['removed']:
+        print('material %s is gone' % label)
+      for kind,sampleID,index,side,method in changes['updated']:
+        print('updated %s %s %s %s' % (kind, sampleID, side, method or ''))
+
+  def collectHeaderCatalog(self):
+    """Read only the NRRD/Analyze headers of every material
+    so spacing, dimensions and voxel type are known without
+    loading any voxel data"""
+    self.headerCatalog = MurineTrialLib.buildHeaderCatalog(self.materials)
+    return self.headerCatalog
+
+  def geometryInconsistencies(self,referenceMethod='Slicer-seg'):
+    """List the materials whose geometry does not match their mr volume
+    or the referenceMethod segmentation of the same sample"""
+    if not self.headerCatalog:
+      self.collectHeaderCatalog()
+    return MurineTrialLib.geometryInconsistencies(self.headerCatalog, referenceMethod)
+
+  def estimateRun(self,labels=None):
+    """Memory (bytes) and time (seconds) estimates for loading
+    the given material labels (default all)"""
+    if not self.headerCatalog:
+      self.collectHeaderCatalog()
+    return MurineTrialLib.estimateResources(self.headerCatalog, labels)
+
+
+  def updateLongitudinal(self,method,timepointDays=None):
+    """Bring the per-subject label volumes of the method up to date.
+    Only the {specie}{subject}time{N} segmentations that are new or
+    changed since the last update are read, and the timepoints that
+    no longer have a segmentation are dropped; the trajectories csv
+    (change from baseline and growth rates) is rewritten from the
+    stored counts.  Returns the labels of the materials that were read.
+    """
+    storePath = os.path.join(self.resultRoot, "longitudinal-%s.json" % method)
+    store = MurineTrialLib.LongitudinalStore(storePath)
+    updated = []
+    timepoints = []
+    for label in MurineTrialLib.materialLabels(self.materials):
+      material = self.materials[label]
+      if label != method + '.' + material['sampleID']:
+        continue
+      subject = "{}{}".format(material['specie'], material['subject'])
+      timepoints.append((subject, material['time']))
+      if store.stale(subject, material['time'], material['segPath']):
+        array,header = self.readVolume(material['segPath'])
+        voxelVolumeMM3 = numpy.array(header['spacing']).prod()
+        store.record(subject, material['time'], material['segPath'], MurineTrialLib.labelCounts(array), voxelVolumeMM3)
+        updated.append(label)
+    # timepoints whose segmentation is gone are dropped
+    dropped = store.retain(timepoints)
+    if updated or dropped:
+      store.save()
+    store.trajectoriesCSV(os.path.join(self.resultRoot, "longitudinal-%s.csv" % method), timepointDays)
+    return updated
 
   def endOf2013reretestStatistics(self,targetDirectory):
     """Calculate the label statistics and put them in a csv file in the target"""
 
-    musclesByIndex = {
-        1 : "SM",
-        2 : "RF",
-        3 : "VLI",
-        4 : "TFL",
-        5 : "SAR",
-        6 : "GRA",
-        7 : "ST",
-        8 : "BFL",
-        9 : "BFB",
-        10 : "VM",
-        11 : "ADD",
-    }
+    musclesByIndex = self.musclesByIndex
 
     subjects = (
         "0001-01001",
@@ -524,6 +1641,7 @@ class MurineTrialLogic:
 
     muscleStats = {}
     fatStats = {}
+    shapeStats = {}
 
     for studyPath in studyPaths:
       studyRoot = os.path.join(self.dataRoot, studyPath)
@@ -568,6 +1686,10 @@ class MurineTrialLogic:
       statLogic = LabelStatistics.LabelStatisticsLogic(mrVolume, labelVolume)
       statLogic.saveStats(statFilePath)
 
+      # shape of all the muscles from one pass over the labels
+      morphometrics = self.labelNodeMorphometrics(repeatLabel, labelVolume, sorted(musclesByIndex.keys()))
+      self.morphometricsCSV(morphometrics, os.path.join(targetDirectory, repeatLabel + "-morphometrics.csv"))
+
       for muscleIndex in range(1,12):
         muscleLabelStats = statLogic.labelStats[muscleIndex,"Volume cc"]
         muscleStats[subjectID,testPoint,muscleIndex] = muscleLabelStats
@@ -577,20 +1699,25 @@ class MurineTrialLogic:
         imatArray = muscleArray * fatArray
         fatRatio = imatArray.sum() / muscleArray.sum()
         fatStats[subjectID,testPoint,muscleIndex] = fatRatio
+        shapeStats[subjectID,testPoint,muscleIndex] = morphometrics[muscleIndex]
 
 
 
     fp = open(os.path.join(targetDirectory,"summary.csv"), "w")
-    fp.write("Subject,Muscle,Volume 1 cc,Volume 2 cc,Volume 3 cc,Ratio 1,Ratio 2,Ratio 3\n");
+    fp.write("Subject,Muscle,Volume 1 cc,Volume 2 cc,Volume 3 cc,Ratio 1,Ratio 2,Ratio 3,Length 1 mm,Length 2 mm,Length 3 mm,Surface 1 mm2,Surface 2 mm2,Surface 3 mm2\n");
     for subject in subjects:
       for muscleIndex in range(1,12):
         csvLine = "%s,%s" % (subject,musclesByIndex[muscleIndex])
         for point in range(1,4):
           testPoint = "round%d" % point
-          csvLine += ",%s" % str(muscleStats[subjectID,testPoint,muscleIndex])
+          csvLine += ",%s" % str(muscleStats[subject,testPoint,muscleIndex])
         for point in range(1,4):
           testPoint = "round%d" % point
-          csvLine += ",%s" % str(fatStats[subjectID,testPoint,muscleIndex])
+          csvLine += ",%s" % str(fatStats[subject,testPoint,muscleIndex])
+        for key in ('lengthMM', 'surfaceAreaMM2'):
+          for point in range(1,4):
+            testPoint = "round%d" % point
+            csvLine += ",%s" % str(shapeStats[subject,testPoint,muscleIndex][key])
         csvLine += "\n"
         fp.write(csvLine)
     fp.close()
@@ -707,28 +1834,96 @@ class MurineTrialLogic:
     based on the current editor parameters
     - make a new hierarchy node
     """
-
+    return self.makeModels([(labelNode, modelName, modelIndex, hierarchyName)])[modelName]
+
+  def makeModels(self,jobs,parentHierarchyName=None,onFinished=None):
+    """Run the model maker for each (labelNode, modelName, modelIndex,
+    hierarchyName) job, with up to modelConcurrency runs at once.
+    Each job gets its own hierarchy node, which is put under a
+    parentHierarchyName hierarchy (if given) and passed to
+    onFinished(job, hierarchy, succeeded) as soon as its run is over.
+    Returns {modelName: hierarchy}.
+    """
     self.delayDisplay("Starting model making",200)
+    parent = None
+    if parentHierarchyName:
+      parent = self.modelHierarchy(parentHierarchyName)
+    hierarchies = {}
+
+    def launch(job):
+      labelNode,modelName,modelIndex,hierarchyName = job
+      hierarchies[modelName] = self.modelHierarchy(hierarchyName)
+      return self.launchModelMaker(labelNode, modelName, modelIndex, hierarchies[modelName])
+
+    def finished(job, cliNode, succeeded):
+      hierarchy = hierarchies[job[1]]
+      if parent:
+        hierarchy.SetParentNodeID(parent.GetID())
+      if not succeeded:
+        print("Model making for %s ended with status %s" % (job[1], cliNode.GetStatusString()))
+      if onFinished:
+        onFinished(job, hierarchy, succeeded)
+
+    scheduler = MurineTrialLib.JobScheduler(launch, self.modelMakerState, self.modelConcurrency, finished)
+    for job in jobs:
+      scheduler.submit(job)
+    if not scheduler.wait(idle=slicer.app.processEvents, timeout=self.modelTimeoutSeconds):
+      print("Model making timed out with %d runs left" % (len(scheduler.running) + len(scheduler.queued)))
+    self.delayDisplay("Done",200)
+    return hierarchies
+
+  def modelHierarchy(self,hierarchyName):
+    hierarchy = slicer.vtkMRMLModelHierarchyNode()
+    hierarchy.SetScene( slicer.mrmlScene )
+    hierarchy.SetName( hierarchyName )
+    slicer.mrmlScene.AddNode( hierarchy )
+    return hierarchy
+
+  def launchModelMaker(self,labelNode,modelName,modelIndex,outHierarchy):
+    """start (without waiting) a model maker run for one label"""
     parameters = {}
     parameters["InputVolume"] = labelNode.GetID()
-    # create models for all labels
     parameters["Name"] = modelName
     parameters["Labels"] = modelIndex
     parameters["GenerateAll"] = False
-    outHierarchy = slicer.vtkMRMLModelHierarchyNode()
-    outHierarchy.SetScene( slicer.mrmlScene )
-    outHierarchy.SetName( hierarchyName )
-    slicer.mrmlScene.AddNode( outHierarchy )
     parameters["ModelSceneFile"] = outHierarchy
-
     modelMaker = slicer.modules.modelmaker
-    self.CLINode = None
-    self.CLINode = slicer.cli.run(modelMaker, self.CLINode, parameters, delete_temporary_files=False)
-    waitCount = 0
-    while self.CLINode.GetStatusString() != 'Completed' and waitCount < 100:
-      self.delayDisplay("Model making in progress (%d)" % waitCount)
-      waitCount += 1
-    self.delayDisplay("Done",200)
+    return slicer.cli.run(modelMaker, None, parameters, delete_temporary_files=False)
+
+  def modelMakerState(self,cliNode):
+    status = cliNode.GetStatusString()
+    if status == 'Completed':
+      return 'done'
+    if status in ('Completed with errors', 'CompletedWithErrors', 'Cancelled'):
+      return 'failed'
+    return 'running'
+
+  def colorModelByLabel(self,modelName,index):
+    """give the model the color of its label"""
+    modelNode = slicer.util.getNode(modelName)
+    colorNode = slicer.util.getNode('vtkMRMLColorTableNodeLabels')
+    lookupTable = colorNode.GetLookupTable()
+    rgb = [0,]*3
+    lookupTable.GetColor(index,rgb)
+    displayNode = modelNode.GetDisplayNode()
+    displayNode.SetColor(rgb)
+    return displayNode
+
+  def makeMuscleModels(self,labelNode,hierarchyName="Muscles",indices=None):
+    """Models of all (or the given) muscles of a muscle label map,
+    made concurrently and gathered under one hierarchy"""
+    if indices is None:
+      indices = sorted(self.musclesByIndex.keys())
+    jobs = []
+    for index in indices:
+      muscle = self.musclesByIndex[index]
+      jobs.append((labelNode, muscle, index, muscle))
+
+    def colorMuscle(job, hierarchy, succeeded):
+      if succeeded:
+        self.colorModelByLabel(job[1], job[2])
+
+    return self.makeModels(jobs, hierarchyName, colorMuscle)
 
   def calculateFatRatio(self,measurements,currentData):
     """Determine the fat ratio over the segmented muscle volume.
@@ -756,26 +1951,13 @@ class MurineTrialLogic:
     print(musclesArray.shape)
     slices = musclesArray.shape[0]
 
-    imatArray = numpy.array(classmap)
-
-    if len(imatArray.shape) > 3 and imatArray.shape[3] > 1:
-      # color image, so IMAT is non-zero green component
-      imatArray = imatArray.transpose()[1].transpose()
-      imatArray[imatArray != 0] = 1
-      print("imat modified")
-      print(imatArray.max())
-    else:
-      # make a new array as a boolean mask for IMAT
-      imatLabel = 5
-      imatArray[imatArray != imatLabel] = 0
-      imatArray[imatArray == imatLabel] = 1
-      print(imatArray.max())
+    # make a new array as a boolean mask for IMAT
+    imatArray = MurineTrialLib.imatMask(classmap)
+    print(imatArray.max())
 
     # make a new array as a boolean mask for the given muscle
     muscleLabel = self.indexByMuscle[measurements.muscle]
-    muscleArray = numpy.array(musclesArray)
-    muscleArray[muscleArray != muscleLabel] = 0
-    muscleArray[muscleArray == muscleLabel] = 1
+    muscleArray = (musclesArray == muscleLabel).astype(musclesArray.dtype)
     print(muscleArray.max())
 
     fatmapLabel = None
@@ -787,20 +1969,14 @@ class MurineTrialLogic:
       fatArray[:] = imatArray * muscleArray
       fatmapLabel.GetImageData().Modified()
 
-    # make models for display
-    self.makeModel( currentData['muscleLabel'],
-          measurements.muscle, self.indexByMuscle[measurements.muscle])
+    # make models for display (the muscle and its fatmap together)
+    modelJobs = [(currentData['muscleLabel'], measurements.muscle, self.indexByMuscle[measurements.muscle], "Models")]
     if fatmapLabel:
-      self.makeModel( fatmapLabel, measurements.muscle + "-IMAT", 1)
+      modelJobs.append((fatmapLabel, measurements.muscle + "-IMAT", 1, "Models"))
+    self.makeModels(modelJobs)
 
     # display the models
-    muscleModelNode = slicer.util.getNode(measurements.muscle)
-    colorNode = slicer.util.getNode('vtkMRMLColorTableNodeLabels')
-    lookupTable = colorNode.GetLookupTable()
-    rgb = [0,]*3
-    lookupTable.GetColor(self.indexByMuscle[measurements.muscle],rgb)
-    displayNode = muscleModelNode.GetDisplayNode()
-    displayNode.SetColor(rgb)
+    displayNode = self.colorModelByLabel(measurements.muscle, self.indexByMuscle[measurements.muscle])
 
     # if the measurement is a fat ratio calculation,
     # then make a lable map to store the per-muscle IMAT
@@ -818,22 +1994,14 @@ class MurineTrialLogic:
     layoutManager = slicer.app.layoutManager()
     layoutManager.resetThreeDViews()
 
-    # calculate the per-slice fat content
-    muscleCount = 0
-    muscleIMATCount = 0
-    for slice in xrange(slices):
-      imatSlice = imatArray[slice]
-      muscleSlice = muscleArray[slice]
-      if imatSlice.max() > 0 and muscleSlice.max() > 0:
-        # this is a slice where the muscle is present and the overall
-        # labelmap is not missing data
-        muscleIMATSlice = imatSlice * muscleSlice
-        muscleCount += muscleSlice.sum()
-        muscleIMATCount += muscleIMATSlice.sum()
-        print("Muscle, imat = (%d, %d)" % (muscleSlice.sum(), muscleIMATSlice.sum()))
-      else:
-        print("Skipping slice %d" % slice)
-    fatRatio = muscleIMATCount / float(muscleCount)
+    # calculate the per-slice fat content, only on slices where the
+    # muscle is present and the overall labelmap is not missing data
+    countedSlices,muscleCounts,muscleIMATCounts = MurineTrialLib.perSliceCounts(muscleArray, imatArray)
+    print("Using %d of %d slices" % (len(countedSlices), slices))
+    # slice-level bootstrap of the ratio from the same counts
+    fatRatio,low,high = MurineTrialLib.bootstrapRatio(muscleIMATCounts, muscleCounts,
+        self.bootstrapReplicates, self.bootstrapConfidence, self.bootstrapSeed)
+    print("Fat ratio %g (%g%% interval %g to %g)" % (fatRatio, 100*self.bootstrapConfidence, low, high))
 
     # calculate the muscle volume if needed
     if len(measurements.samples) == 1 and math.isnan(measurements.samples[0]):
@@ -853,16 +2021,31 @@ class MurineTrialLogic:
     fm.property = "fatRatio"
     fm.label = '%s-%s-%s-%s' % (fm.subject, fm.muscle, fm.property[0], self.timePointCodeMap[fm.timepoint])
     fm.samples = [fatRatio]
+    fm.confidenceInterval = (low, high)
     return fm
 
+  def morphometricsCSV(self,morphometrics,filePath):
+    """write the labelMorphometrics of all the muscles to a csv file"""
+    fp = open(filePath,"w")
+    fp.write("Muscle,Index,Voxels,Volume mm3," + ",".join(MurineTrialLib.morphometricColumns) + "\n")
+    for index in sorted(morphometrics.keys()):
+      result = morphometrics[index]
+      values = [self.musclesByIndex.get(index, str(index)), index, result['voxels'], result['volumeMM3']]
+      values += list(MurineTrialLib.morphometricValues(result))
+      fp.write(",".join([str(value) for value in values]) + "\n")
+    fp.close()
+
   def csv(self,measurementsList,filePath):
     fp = open(filePath,"w")
-    fp.write("Subject,Property,Muscle,Timepoint,SampleValue,SampleOrder\n")
+    fp.write("Subject,Property,Muscle,Timepoint,SampleValue,SampleOrder,CILow,CIHigh\n")
     for m in measurementsList:
+      interval = ","
+      if hasattr(m, 'confidenceInterval'):
+        interval = "%g,%g" % m.confidenceInterval
       sampleOrder = 1
       for sample in m.samples:
-        values = (m.subject, m.property, m.muscle, m.timepoint, sample, sampleOrder)
-        fp.write("\"%s\",\"%s\",\"%s\",\"%s\",%g,%d\n" % values)
+        values = (m.subject, m.property, m.muscle, m.timepoint, sample, sampleOrder, interval)
+        fp.write("\"%s\",\"%s\",\"%s\",\"%s\",%g,%d,%s\n" % values)
         sampleOrder += 1
     fp.close()
 
@@ -878,8 +2061,11 @@ class MurineTrialTest(unittest.TestCase):
     have all taken place before the test continues and 2) it
     shows the user/developer/tester the state of the test
     so that we'll know when it breaks.
+    Outside Slicer (for the tests that need only numpy) it just prints.
     """
     print(message)
+    if not slicerAvailable():
+      return
     self.info = qt.QDialog()
     self.infoLayout = qt.QVBoxLayout()
     self.info.setLayout(self.infoLayout)
@@ -898,8 +2084,337 @@ class MurineTrialTest(unittest.TestCase):
     """
     self.setup()
 
+    self.test_Headers()
+    self.test_Decode()
+    self.test_Morphometrics()
+    self.test_Components()
+    self.test_Watch()
+    self.test_Longitudinal()
+    self.test_Pyramid()
+    self.test_Bootstrap()
     self.test_MurineTrial1()
 
+  def test_Headers(self):
+    """Check the header-only geometry checks and resource estimate
+    on small NRRD and Analyze files"""
+    import tempfile, shutil, struct
+    self.delayDisplay("Testing headers")
+    def writeNRRD(path,sizes,spacing):
+      fp = open(path, 'wb')
+      fp.write(b'NRRD0004\ntype: short\ndimension: 3\nspace: left-posterior-superior\n')
+      fp.write(('sizes: %d %d %d\n' % sizes).encode('latin-1'))
+      fp.write(('space directions: (%g,0,0) (0,%g,0) (0,0,%g)\n' % spacing).encode('latin-1'))
+      fp.write(b'space origin: (0,0,0)\nendian: little\nencoding: raw\n\n')
+      fp.write(b'\0' * (2 * sizes[0] * sizes[1] * sizes[2]))
+      fp.close()
+    def writeAnalyze(path,sizes,spacing):
+      raw = bytearray(348)
+      raw[0:4] = struct.pack('<i', 348)
+      raw[40:56] = struct.pack('<8h', 3, sizes[0], sizes[1], sizes[2], 1, 1, 1, 1)
+      raw[70:72] = struct.pack('<h', 4)
+      raw[76:108] = struct.pack('<8f', 0., spacing[0], spacing[1], spacing[2], 0., 0., 0., 0.)
+      fp = open(path, 'wb')
+      fp.write(bytes(raw))
+      fp.close()
+      fp = open(os.path.splitext(path)[0] + '.img', 'wb')
+      fp.write(b'\0' * (2 * sizes[0] * sizes[1] * sizes[2]))
+      fp.close()
+    directory = tempfile.mkdtemp()
+    try:
+      materials = {}
+      for label,write,extension,segSizes,segSpacing in (
+          ('Slicer-seg.mouse1time1', writeNRRD, '.nrrd', (6,5,4), (0.5,0.5,1.)),
+          ('Slicer-seg-corr.mouse1time1', writeNRRD, '.nrrd', (6,5,4), (0.6,0.6,1.)),
+          ('Novartis-GIGseg.mouse1time1', writeAnalyze, '.hdr', (6,5,3), (0.5,0.5,1.)) ):
+        mrPath = os.path.join(directory, label + extension)
+        segPath = os.path.join(directory, label + '-label' + extension)
+        write(mrPath, (6,5,4), segSpacing)
+        write(segPath, segSizes, segSpacing)
+        materials[label] = {'mrPath': mrPath, 'segPath': segPath}
+      catalog = MurineTrialLib.buildHeaderCatalog(materials)
+      self.assertEqual(catalog['Novartis-GIGseg.mouse1time1']['seg']['ijkToRAS'], None)
+      issues = MurineTrialLib.geometryInconsistencies(catalog)
+      found = sorted([(issue['label'], issue['field']) for issue in issues])
+      self.assertEqual(found, [
+          ('Novartis-GIGseg.mouse1time1', 'dimensions'),
+          ('Novartis-GIGseg.mouse1time1', 'ijkToRAS'),
+          ('Novartis-GIGseg.mouse1time1-label', 'dimensions'),
+          ('Slicer-seg-corr.mouse1time1', 'ijkToRAS'),
+          ('Slicer-seg-corr.mouse1time1', 'spacing') ])
+      # a missing orientation is an issue with the value None
+      for issue in issues:
+        if issue['label'] == 'Novartis-GIGseg.mouse1time1' and issue['field'] == 'ijkToRAS':
+          self.assertEqual(issue['value'], None)
+          self.assertEqual(issue['reference'], 'Slicer-seg.mouse1time1')
+          self.assertEqual(issue['expected'][0][0], -0.5)
+
+      estimate = MurineTrialLib.estimateResources(catalog)
+      self.assertEqual(estimate['volumes'], 6)
+      self.assertEqual(estimate['voxels'], 5 * 120 + 90)
+      self.assertEqual(estimate['decodedBytes'], 2 * (5 * 120 + 90))
+      self.assertEqual(estimate['peakMaterialBytes'], 2 * 240)
+      self.assertAlmostEqual(estimate['seconds'], estimate['fileBytes'] / 200e6)
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Headers test passed!')
+
+  def test_Decode(self):
+    """Check gzip and blocked gzip (BGZF) decoding, with and without
+    a byte skip, against the array that was written, with and without
+    the decoded volume cache"""
+    import tempfile, shutil, struct, zlib
+    self.delayDisplay("Testing decoding")
+    array = (numpy.arange(4*5*6, dtype='int16') - 50).reshape((4,5,6))
+    raw = array.tobytes()
+    def gzip(data):
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      return compressor.compress(data) + compressor.flush()
+    blocks = b''
+    for start in range(0, len(raw), 64):
+      piece = raw[start:start+64]
+      compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+      deflated = compressor.compress(piece) + compressor.flush()
+      blocks += b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H', 6)
+      blocks += b'BC' + struct.pack('<HH', 2, 18 + len(deflated) + 8 - 1)
+      blocks += deflated + struct.pack('<II', zlib.crc32(piece) & 0xffffffff, len(piece))
+    directory = tempfile.mkdtemp()
+    try:
+      cache = MurineTrialLib.DecodedVolumeCache(os.path.join(directory, 'cache'))
+      # byte skip counts decoded bytes, -1 for data at the end
+      for name,payload,skip in (('gzip', gzip(raw), b''), ('bgzf', blocks, b''),
+                                ('skip', gzip(b'skip' + raw), b'byte skip: 4\n'),
+                                ('skipEnd', gzip(b'skip' + raw), b'byte skip: -1\n')):
+        path = os.path.join(directory, name + '.nrrd')
+        fp = open(path, 'wb')
+        fp.write(b'NRRD0004\ntype: short\ndimension: 3\nsizes: 6 5 4\nendian: little\nencoding: gzip\nspacings: 1 1 2\n')
+        fp.write(skip + b'\n')
+        fp.write(payload)
+        fp.close()
+        # no cache, then a cache miss and a cache hit
+        for volumeCache in (None, cache, cache):
+          decoded,header = MurineTrialLib.readVolume(path, volumeCache, threads=2)
+          self.assertEqual(header['spacing'], (1., 1., 2.))
+          self.assertTrue(numpy.array_equal(decoded, array))
+      self.assertEqual(len(cache.entries()), 4)
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Decoding test passed!')
+
+  def test_Morphometrics(self):
+    """Check the labeled-reduction shape measures on a synthetic box"""
+    self.delayDisplay("Testing morphometrics")
+    labelArray = numpy.zeros((10,20,30), dtype='int16')
+    labelArray[2:6, 5:10, 4:24] = 3
+    results = MurineTrialLib.labelMorphometrics(labelArray, spacing=(0.5,0.5,2.), labels=[3,4])
+    box = results[3]
+    self.assertEqual(box['voxels'], 4*5*20)
+    self.assertAlmostEqual(box['volumeMM3'], 4*5*20 * 0.5*0.5*2.)
+    self.assertAlmostEqual(box['centroid'][0], 13.5 * 0.5)
+    self.assertAlmostEqual(box['centroid'][2], 3.5 * 2.)
+    self.assertAlmostEqual(abs(box['axes'][0][0]), 1.)
+    # 10mm x 2.5mm x 8mm box
+    self.assertAlmostEqual(box['faceAreaMM2'], 2 * (10*2.5 + 10*8 + 2.5*8))
+    self.assertEqual(results[4]['voxels'], 0)
+    self.delayDisplay('Morphometrics test passed!')
+
+  def test_Components(self):
+    """Check the stray component report and cleanup on a small map"""
+    self.delayDisplay("Testing connected components")
+    labelArray = numpy.zeros((6,8,10), dtype='int16')
+    # label 1: a U shape (connected only through its base) and a stray voxel
+    labelArray[1:5, 1, 1:4] = 1
+    labelArray[1:5, 5, 1:4] = 1
+    labelArray[1:5, 1:6, 1] = 1
+    labelArray[5, 7, 9] = 1
+    # label 2: two pieces touching only at a corner (not a face)
+    labelArray[0:2, 0:2, 6:8] = 2
+    labelArray[2, 2, 8] = 2
+    # label 3 touches label 1 but is its own component
+    labelArray[1:5, 2:5, 2] = 3
+    results = MurineTrialLib.strayComponents(labelArray, spacing=(0.5,0.5,2.))
+    self.assertEqual(results[1]['components'], 2)
+    self.assertEqual(results[1]['strayVoxels'], 1)
+    self.assertEqual(results[1]['mainVoxels'], (labelArray == 1).sum() - 1)
+    self.assertEqual(results[1]['strays'][0]['ijk'], (9., 7., 5.))
+    self.assertAlmostEqual(results[1]['cleanedVolumeMM3'], results[1]['mainVoxels'] * 0.5)
+    self.assertEqual(results[2]['components'], 2)
+    self.assertEqual(results[2]['strays'][0]['voxels'], 1)
+    self.assertEqual(results[3]['components'], 1)
+    self.assertEqual(results[3]['strays'], [])
+    self.assertEqual(MurineTrialLib.strayComponents(numpy.zeros((3,4,5), dtype='uint8')), {})
+    cleaned = MurineTrialLib.removeStrayComponents(labelArray)
+    self.assertEqual(cleaned[5,7,9], 0)
+    self.assertEqual(cleaned[2,2,8], 0)
+    self.assertEqual((cleaned != labelArray).sum(), 2)
+    self.delayDisplay('Components test passed!')
+
+  def test_Watch(self):
+    """Check that files are reported once they settle and that csv
+    rows are replaced in place"""
+    import tempfile, shutil
+    self.delayDisplay("Testing watching")
+    def write(path,text):
+      fp = open(path, 'w')
+      fp.write(text)
+      fp.close()
+    directory = tempfile.mkdtemp()
+    try:
+      now = [0.]
+      settler = MurineTrialLib.FileSettler(settleSeconds=10., clock=lambda: now[0])
+      old = os.path.join(directory, 'old.nrrd')
+      new = os.path.join(directory, 'new.nrrd')
+      write(old, 'old')
+      settler.prime([old])
+      self.assertEqual(settler.poll([old]), ([], []))
+      # a new file is pending until it has not changed for settleSeconds
+      write(new, 'half')
+      self.assertEqual(settler.poll([old, new]), ([], []))
+      self.assertTrue(new in settler.pending)
+      now[0] = 5.
+      write(new, 'half written')
+      self.assertEqual(settler.poll([old, new]), ([], []))
+      now[0] = 14.
+      self.assertEqual(settler.poll([old, new]), ([], []))
+      now[0] = 15.
+      self.assertEqual(settler.poll([old, new]), ([new], []))
+      self.assertFalse(new in settler.pending)
+      self.assertEqual(settler.poll([old, new]), ([], []))
+      os.remove(old)
+      self.assertEqual(settler.poll([new]), ([], [old]))
+
+      csvPath = os.path.join(directory, 'results.csv')
+      # a repeated row for a key is dropped with the replacement
+      write(csvPath, 'sampleID, side, volume\na, right, 1\na, left, 2\nb, right, 3\na, right, 4\n')
+      MurineTrialLib.replaceCSVRows(csvPath, {
+          ('a', 'right'): 'a, right, 10',
+          ('b', 'right'): None,
+          ('c', 'left'): 'c, left, 5'}, 2)
+      lines = open(csvPath).read().splitlines()
+      self.assertEqual(lines, ['sampleID, side, volume', 'a, right, 10', 'a, left, 2', 'c, left, 5'])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Watching test passed!')
+
+  def test_Longitudinal(self):
+    """Check the trajectories of a stored subject and that entries
+    go stale when their segmentation changes and can be dropped"""
+    import tempfile, shutil
+    self.delayDisplay("Testing longitudinal volumes")
+    directory = tempfile.mkdtemp()
+    try:
+      store = MurineTrialLib.LongitudinalStore(os.path.join(directory, 'longitudinal.json'))
+      segPaths = {}
+      for time,voxels in ((1, 10), (2, 20), (3, 40)):
+        segPaths[time] = os.path.join(directory, 'mouse1time%d-label.nrrd' % time)
+        fp = open(segPaths[time], 'w')
+        fp.write('seg')
+        fp.close()
+        self.assertTrue(store.stale('mouse1', time, segPaths[time]))
+        store.record('mouse1', time, segPaths[time], {1: voxels, 2: 4}, 0.5)
+        self.assertFalse(store.stale('mouse1', time, segPaths[time]))
+      self.assertTrue(store.stale('mouse1', 1, segPaths[2]))
+      fp = open(segPaths[1], 'w')
+      fp.write('rewritten seg')
+      fp.close()
+      self.assertTrue(store.stale('mouse1', 1, segPaths[1]))
+
+      rows = dict([((row['label'], row['time']), row) for row in store.trajectories()])
+      self.assertEqual(rows[(1,3)]['volumeMM3'], 20.)
+      self.assertEqual(rows[(1,3)]['baselineTime'], 1)
+      self.assertEqual(rows[(1,3)]['changeFromBaselineMM3'], 15.)
+      self.assertAlmostEqual(rows[(1,3)]['changeFromBaselinePercent'], 300.)
+      self.assertEqual(rows[(1,2)]['growthRateMM3'], 5.)
+      self.assertAlmostEqual(rows[(1,2)]['relativeGrowthRate'], numpy.log(2.))
+      self.assertTrue(numpy.isnan(rows[(1,1)]['growthRateMM3']))
+      self.assertEqual(rows[(2,3)]['changeFromBaselineMM3'], 0.)
+      # rates per day when the timepoints have study days
+      rows = dict([((row['label'], row['time']), row) for row in store.trajectories({1: 0, 2: 7, 3: 14})])
+      self.assertAlmostEqual(rows[(1,2)]['growthRateMM3'], 5. / 7.)
+
+      # a timepoint whose segmentation is gone is dropped
+      self.assertEqual(store.retain([('mouse1', 1), ('mouse1', 2)]), [('mouse1', 3)])
+      store.save()
+      store = MurineTrialLib.LongitudinalStore(store.filePath)
+      self.assertEqual(sorted(set([row['time'] for row in store.trajectories()])), [1, 2])
+      self.assertEqual(store.retain([]), [('mouse1', 1), ('mouse1', 2)])
+      self.assertEqual(store.trajectories(), [])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Longitudinal test passed!')
+
+  def test_Pyramid(self):
+    """Check mode pooling of labels, the geometry of a preview level
+    and the preview cache"""
+    import tempfile, shutil
+    self.delayDisplay("Testing preview pyramids")
+    labelArray = numpy.zeros((3,4,5), dtype='int16')
+    labelArray[0:2, 0:2, 0:2] = 2
+    labelArray[0, 0, 0:2] = 1
+    labelArray[0:2, 0:2, 2] = 1
+    labelArray[0:2, 0:2, 3] = 3
+    modes = MurineTrialLib.downsampleMode(labelArray, (2,2,2))
+    self.assertEqual(modes.shape, (2,2,3))
+    # 6 of 8 voxels are 2; a 4 to 4 tie goes to the smaller label
+    self.assertEqual(modes[0,0,0], 2)
+    self.assertEqual(modes[0,0,1], 1)
+    # the last block of an odd axis is edge padded
+    self.assertEqual(modes[1,1,2], 0)
+
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'seg.nrrd')
+      fp = open(path, 'w')
+      fp.write('seg')
+      fp.close()
+      header = {'path': path, 'dataPath': path, 'spacing': (0.5, 0.5, 2.),
+                'ijkToRAS': [[0.5, 0., 0., 10.], [0., 0.5, 0., 20.], [0., 0., 2., 30.], [0., 0., 0., 1.]]}
+      pyramid = MurineTrialLib.buildPyramid(labelArray, header, 2, labelMap=True)
+      levelArray,levelHeader = pyramid[0]
+      self.assertEqual(levelHeader['dimensions'], (3, 2, 2))
+      self.assertEqual(levelHeader['spacing'], (1., 1., 4.))
+      # the origin moves to the center of the first block
+      origin = [row[3] for row in levelHeader['ijkToRAS'][:3]]
+      self.assertEqual(origin, [10.25, 20.25, 31.])
+      self.assertEqual(pyramid[1][1]['spacing'], (2., 2., 8.))
+
+      cache = MurineTrialLib.PreviewPyramidCache(os.path.join(directory, 'previews'))
+      self.assertEqual(cache.get(header, 1), None)
+      cache.put(header, pyramid)
+      cachedArray,cachedHeader = cache.get(header, 1)
+      self.assertTrue(numpy.array_equal(cachedArray, levelArray))
+      self.assertEqual(cachedHeader['spacing'], [1., 1., 4.])
+      # a new version of the source replaces the old pyramid
+      fp = open(path, 'w')
+      fp.write('new seg')
+      fp.close()
+      self.assertEqual(cache.get(header, 1), None)
+      cache.put(header, pyramid)
+      self.assertEqual(len(cache.entries()), 1)
+      cache.clear()
+      self.assertEqual(cache.entries(), [])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Pyramid test passed!')
+
+  def test_Bootstrap(self):
+    """Check the bootstrap estimates and intervals with a fixed seed"""
+    self.delayDisplay("Testing bootstrap intervals")
+    numerators = [1., 3., 2., 5., 4.]
+    denominators = [10., 20., 15., 30., 25.]
+    estimate,low,high = MurineTrialLib.bootstrapRatio(numerators, denominators, replicates=500, seed=1)
+    self.assertAlmostEqual(estimate, 15. / 100.)
+    self.assertTrue(low <= estimate <= high)
+    self.assertTrue(low < high)
+    self.assertEqual((estimate,low,high), MurineTrialLib.bootstrapRatio(numerators, denominators, replicates=500, seed=1))
+    estimate,low,high = MurineTrialLib.bootstrapMean([168., 170., 165., 171.], replicates=500, seed=1)
+    self.assertAlmostEqual(estimate, 168.5)
+    self.assertTrue(low <= estimate <= high)
+    for result in (MurineTrialLib.bootstrapRatio([], []),
+                   MurineTrialLib.bootstrapRatio([1., 2.], [0., 0.]),
+                   MurineTrialLib.bootstrapMean([])):
+      self.assertTrue(numpy.isnan(result).all())
+    self.delayDisplay('Bootstrap test passed!')
+
   def test_MurineTrial1(self,galleryDir='/tmp/muscle-gallery'):
     """ Ideally you should have several levels of tests.  At the lowest level
     tests sould exercise the functionality of the logic with different inputs
@@ -933,7 +2448,7 @@ class MurineTrialTest(unittest.TestCase):
         currentData = logic.loadMeasurementVolumes(measurements)
         fatRatioMeasurement = logic.calculateFatRatio(measurements, currentData)
         fatRatioMeasurementsList.append(fatRatioMeasurement)
-      except Exception, e:
+      except Exception as e:
         import traceback
         traceback.print_exc()
         qt.QMessageBox.warning(slicer.util.mainWindow(),
@@ -0,0 +1,13 @@
+"""Helpers for the MurineTrial module that do not need Slicer"""
+
+from .headers import readHeader, readNRRDHeader, readAnalyzeHeader, decodedBytes
+from .headers import materialLabels, buildHeaderCatalog, geometryInconsistencies, estimateResources
+from .decode import DecodedVolumeCache, readVolume, readVolumes, arrayShape, headerIJKToRAS
+from .tasks import BackgroundTask, JobScheduler
+from .morphometrics import morphometricColumns, labelMorphometrics, morphometricValues
+from .longitudinal import trajectoryColumns, labelCounts, LongitudinalStore
+from .volumetrics import labelVolume, imatMask, perSliceCounts
+from .pyramid import downsampleMean, downsampleMode, buildPyramid, PreviewPyramidCache
+from .bootstrap import resamplingWeights, percentileInterval, bootstrapRatio, bootstrapMean
+from .components import strayComponents, removeStrayComponents
+from .watch import FileSettler, replaceCSVRows
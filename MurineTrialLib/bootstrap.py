@@ -0,0 +1,55 @@
+import numpy
+
+#
+# Bootstrap confidence intervals from small vectors of counts or values.
+#
+# All the replicates are drawn at once as a (replicates, n) matrix of
+# multinomial resampling weights, so each statistic is a matrix-vector
+# product rather than a python loop, and the voxels are never touched
+# again once the per-slice (or per-repeat) summaries exist.
+#
+
+def resamplingWeights(n, replicates, randomState):
+  """(replicates, n) counts of how often each item is drawn in each
+  resample with replacement of n items"""
+  return randomState.multinomial(n, numpy.ones(n) / n, size=replicates).astype('float64')
+
+def percentileInterval(values, confidence=0.95):
+  """(low, high) percentile interval of the replicate statistics"""
+  tail = 50. * (1. - confidence)
+  values = numpy.asarray(values, dtype='float64')
+  values = values[numpy.isfinite(values)]
+  if len(values) == 0:
+    return (float('nan'), float('nan'))
+  low, high = numpy.percentile(values, [tail, 100. - tail])
+  return (float(low), float(high))
+
+def bootstrapRatio(numerators, denominators, replicates=2000, confidence=0.95, seed=None):
+  """Ratio of sums with a bootstrap interval from resampling the
+  (numerator, denominator) pairs, e.g. the per-slice muscle IMAT and
+  muscle counts of the fat ratio.
+  Returns (estimate, low, high)."""
+  numerators = numpy.asarray(numerators, dtype='float64')
+  denominators = numpy.asarray(denominators, dtype='float64')
+  if len(denominators) == 0 or not denominators.sum():
+    return (float('nan'), float('nan'), float('nan'))
+  estimate = numerators.sum() / denominators.sum()
+  weights = resamplingWeights(len(denominators), replicates, numpy.random.RandomState(seed))
+  resampledDenominators = numpy.dot(weights, denominators)
+  resampledNumerators = numpy.dot(weights, numerators)
+  valid = resampledDenominators > 0
+  ratios = resampledNumerators[valid] / resampledDenominators[valid]
+  low, high = percentileInterval(ratios, confidence)
+  return (float(estimate), low, high)
+
+def bootstrapMean(values, replicates=2000, confidence=0.95, seed=None):
+  """Mean with a bootstrap interval from resampling the values,
+  e.g. the volumes of the repeated segmentations of a sample.
+  Returns (estimate, low, high)."""
+  values = numpy.asarray(values, dtype='float64')
+  if len(values) == 0:
+    return (float('nan'), float('nan'), float('nan'))
+  weights = resamplingWeights(len(values), replicates, numpy.random.RandomState(seed))
+  means = numpy.dot(weights, values) / len(values)
+  low, high = percentileInterval(means, confidence)
+  return (float(values.mean()), low, high)
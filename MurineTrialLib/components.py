@@ -0,0 +1,162 @@
+import numpy
+
+#
+# Connected components of all the labels of a label map in one pass.
+#
+# The voxels are first grouped into runs of the same label along i,
+# then runs touching in j or k with the same label are merged with a
+# vectorized union-find (hook roots onto the smaller root, then pointer
+# jumping), so the work is in whole-array numpy operations over runs
+# rather than voxels.  Faces are connected (6-connectivity).
+#
+
+def _runComponents(labelArray):
+  """Runs and their components:
+  runId: per voxel run index (-1 for background), flat
+  runStart, runLength, runLabel: per run
+  runComponent: per run component index
+  componentLabel, componentVoxels: per component"""
+  labelArray = numpy.asarray(labelArray)
+  foreground = labelArray != 0
+  start = numpy.empty(labelArray.shape, dtype=bool)
+  start[..., 0] = True
+  start[..., 1:] = labelArray[..., 1:] != labelArray[..., :-1]
+  start &= foreground
+  end = numpy.empty(labelArray.shape, dtype=bool)
+  end[..., -1] = True
+  end[..., :-1] = labelArray[..., :-1] != labelArray[..., 1:]
+  end &= foreground
+  flat = labelArray.ravel()
+  runStart = numpy.flatnonzero(start)
+  runLength = numpy.flatnonzero(end) - runStart + 1
+  runLabel = flat[runStart]
+  runCount = len(runStart)
+  indexType = 'int32' if runCount < 2**31 else 'int64'
+  runId = numpy.cumsum(start.ravel(), dtype=indexType) - 1
+  runId[~foreground.ravel()] = -1
+  runId = runId.reshape(labelArray.shape)
+
+  # pairs of runs with the same label that touch across j or k
+  pairs = []
+  for axis in (0, 1):
+    lower = [slice(None)] * 3
+    upper = [slice(None)] * 3
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    lower, upper = tuple(lower), tuple(upper)
+    touching = (labelArray[lower] == labelArray[upper]) & foreground[upper]
+    a = runId[lower][touching].astype('int64')
+    b = runId[upper][touching].astype('int64')
+    pairs.append(numpy.unique(a * runCount + b))
+  pairs = numpy.concatenate(pairs)
+  edgeA = pairs // max(runCount, 1)
+  edgeB = pairs % max(runCount, 1)
+
+  parent = numpy.arange(runCount)
+  while len(edgeA):
+    rootA = parent[edgeA]
+    rootB = parent[edgeB]
+    unsettled = rootA != rootB
+    edgeA, edgeB = edgeA[unsettled], edgeB[unsettled]
+    rootA, rootB = rootA[unsettled], rootB[unsettled]
+    if not len(edgeA):
+      break
+    numpy.minimum.at(parent, numpy.maximum(rootA, rootB), numpy.minimum(rootA, rootB))
+    while True:
+      grandparent = parent[parent]
+      if numpy.array_equal(grandparent, parent):
+        break
+      parent = grandparent
+
+  roots, runComponent = numpy.unique(parent, return_inverse=True)
+  componentLabel = runLabel[roots]
+  componentVoxels = numpy.bincount(runComponent, weights=runLength, minlength=len(roots)).astype('int64')
+  return {'runId': runId, 'runStart': runStart, 'runLength': runLength, 'runLabel': runLabel,
+          'runComponent': runComponent, 'componentLabel': componentLabel,
+          'componentVoxels': componentVoxels}
+
+def _mainComponents(components):
+  """Per component True for the largest component of its label"""
+  componentLabel = components['componentLabel']
+  order = numpy.lexsort((-components['componentVoxels'], componentLabel))
+  first = numpy.ones(len(order), dtype=bool)
+  first[1:] = componentLabel[order][1:] != componentLabel[order][:-1]
+  isMain = numpy.zeros(len(order), dtype=bool)
+  isMain[order[first]] = True
+  return isMain
+
+def strayComponents(labelArray, ijkToRAS=None, spacing=(1., 1., 1.), labels=None):
+  """Components of each label apart from its largest (main) one.
+
+  labelArray is indexed [k,j,i]; ijkToRAS (4x4) or spacing place the
+  stray centroids.  Returns a dictionary keyed by label value with:
+    components: number of connected components
+    voxels, mainVoxels, strayVoxels
+    volumeMM3, cleanedVolumeMM3 (main component only)
+    strays: list of {'voxels', 'ijk', 'centroid'} for the other
+            components, largest first, with the ijk and RAS centroids
+  """
+  labelArray = numpy.asarray(labelArray)
+  if ijkToRAS is None:
+    matrix = numpy.diag(list(spacing) + [1.])
+  else:
+    matrix = numpy.array(ijkToRAS, dtype='float64')
+  voxelVolume = abs(numpy.linalg.det(matrix[:3, :3]))
+
+  components = _runComponents(labelArray)
+  isMain = _mainComponents(components)
+  componentLabel = components['componentLabel']
+  componentVoxels = components['componentVoxels']
+  runComponent = components['runComponent']
+  runStart = components['runStart']
+  runLength = components['runLength'].astype('float64')
+
+  # centroids from run sums: i goes over the run, j and k are fixed
+  sliceSize = labelArray.shape[1] * labelArray.shape[2]
+  k, remainder = numpy.divmod(runStart, sliceSize)
+  j, i = numpy.divmod(remainder, labelArray.shape[2])
+  count = len(componentVoxels)
+  safeVoxels = numpy.maximum(componentVoxels, 1)
+  centroidIJK = numpy.empty((count, 3))
+  centroidIJK[:, 0] = numpy.bincount(runComponent, weights=runLength * (i + (runLength - 1) / 2.), minlength=count)
+  centroidIJK[:, 1] = numpy.bincount(runComponent, weights=runLength * j, minlength=count)
+  centroidIJK[:, 2] = numpy.bincount(runComponent, weights=runLength * k, minlength=count)
+  centroidIJK /= safeVoxels[:, numpy.newaxis]
+  centroidRAS = numpy.dot(matrix[:3, :3], centroidIJK.T).T + matrix[:3, 3]
+
+  if labels is None:
+    labels = sorted(set([int(label) for label in componentLabel]))
+  results = {}
+  for label in labels:
+    members = numpy.flatnonzero(componentLabel == label)
+    strays = members[~isMain[members]]
+    strays = strays[numpy.argsort(-componentVoxels[strays], kind='mergesort')]
+    voxels = int(componentVoxels[members].sum())
+    mainVoxels = int(componentVoxels[members[isMain[members]]].sum())
+    result = {}
+    result['components'] = len(members)
+    result['voxels'] = voxels
+    result['mainVoxels'] = mainVoxels
+    result['strayVoxels'] = voxels - mainVoxels
+    result['volumeMM3'] = voxels * voxelVolume
+    result['cleanedVolumeMM3'] = mainVoxels * voxelVolume
+    result['strays'] = [{'voxels': int(componentVoxels[c]),
+                         'ijk': tuple(centroidIJK[c]),
+                         'centroid': tuple(centroidRAS[c])} for c in strays]
+    results[int(label)] = result
+  return results
+
+def removeStrayComponents(labelArray):
+  """Copy of the label array with only the largest component of each
+  label kept (the stray voxels become background)"""
+  labelArray = numpy.asarray(labelArray)
+  components = _runComponents(labelArray)
+  isMain = _mainComponents(components)
+  runId = components['runId']
+  strayRun = ~isMain[components['runComponent']]
+  cleaned = labelArray.copy()
+  foreground = runId >= 0
+  stray = numpy.zeros(labelArray.shape, dtype=bool)
+  stray[foreground] = strayRun[runId[foreground]]
+  cleaned[stray] = 0
+  return cleaned
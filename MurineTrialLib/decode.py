@@ -0,0 +1,369 @@
+import os
+import bz2
+import json
+import struct
+import zlib
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from .headers import readHeader, decodedBytes
+
+#
+# Decoding of the voxel data described by a header.
+#
+# zlib releases the GIL while inflating, so python threads give real
+# parallelism both across volumes (mr and seg of a material) and across
+# the independent blocks of blocked gzip (BGZF) payloads.  A classic
+# single-member gzip stream, as written by ITK, can only be inflated
+# serially; for those the decoded volume cache is what saves the time.
+#
+
+def defaultThreads():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+def arrayShape(header):
+  """Numpy shape (slowest axis first) of the volume described by the header"""
+  i, j, k = header['dimensions']
+  components = header['components']
+  if components == 1:
+    return (k, j, i)
+  if header['format'] == 'nrrd':
+    return (k, j, i, components)
+  return (components, k, j, i)
+
+def _dataOffset(header, fp):
+  """Position of the (possibly compressed) payload in the data file"""
+  offset = header['dataOffset']
+  fp.seek(offset)
+  for line in range(header['lineSkip']):
+    fp.readline()
+  offset = fp.tell()
+  if header['encoding'] == 'raw':
+    if header['byteSkip'] == -1:
+      return header['fileBytes'] - decodedBytes(header)
+    offset += header['byteSkip']
+  return offset
+
+def _bgzfSpans(payload):
+  """(start,end) of the raw deflate data in each BGZF block,
+  or None if the payload is not a blocked gzip stream"""
+  spans = []
+  offset = 0
+  length = len(payload)
+  while offset < length:
+    if payload[offset:offset+4] != b'\x1f\x8b\x08\x04':
+      return None
+    extraLength = struct.unpack('<H', payload[offset+10:offset+12])[0]
+    extra = payload[offset+12:offset+12+extraLength]
+    blockSize = None
+    position = 0
+    while position + 4 <= len(extra):
+      subfieldLength = struct.unpack('<H', extra[position+2:position+4])[0]
+      if extra[position:position+2] == b'BC' and subfieldLength == 2:
+        blockSize = struct.unpack('<H', extra[position+4:position+6])[0] + 1
+      position += 4 + subfieldLength
+    if blockSize is None:
+      return None
+    spans.append((offset + 12 + extraLength, offset + blockSize - 8))
+    offset += blockSize
+  return spans
+
+def _inflateBlocks(payload, spans, threads):
+  def inflate(span):
+    return zlib.decompress(payload[span[0]:span[1]], -zlib.MAX_WBITS)
+  pool = ThreadPool(max(1, min(threads, len(spans))))
+  try:
+    pieces = pool.map(inflate, spans)
+  finally:
+    pool.close()
+    pool.join()
+  return numpy.frombuffer(b''.join(pieces), dtype='u1')
+
+def _inflateStream(payload, nbytes=None):
+  """Inflate one or more concatenated gzip members into a preallocated
+  buffer of nbytes, or all of them when nbytes is None"""
+  if nbytes is None:
+    pieces = []
+    remaining = payload
+    while remaining[:2] == b'\x1f\x8b':
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      pieces.append(decompressor.decompress(remaining) + decompressor.flush())
+      remaining = decompressor.unused_data
+    return numpy.frombuffer(b''.join(pieces), dtype='u1')
+  out = numpy.empty(nbytes, dtype='u1')
+  position = 0
+  remaining = payload
+  while remaining[:2] == b'\x1f\x8b' and position < nbytes:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    piece = decompressor.decompress(remaining)
+    piece += decompressor.flush()
+    count = min(len(piece), nbytes - position)
+    out[position:position+count] = numpy.frombuffer(piece, dtype='u1', count=count)
+    position += count
+    remaining = decompressor.unused_data
+  if position < nbytes:
+    raise IOError('Compressed volume data is truncated')
+  return out
+
+def decodePayload(header, threads=None):
+  """Return the decoded bytes of the volume as a flat uint8 array.
+  Raw data is memory mapped rather than read."""
+  nbytes = decodedBytes(header)
+  fp = open(header['dataPath'], 'rb')
+  try:
+    offset = _dataOffset(header, fp)
+    encoding = header['encoding']
+    if encoding == 'raw':
+      return numpy.memmap(header['dataPath'], dtype='u1', mode='r', offset=offset, shape=(nbytes,))
+    fp.seek(offset)
+    payload = fp.read()
+  finally:
+    fp.close()
+  # byte skip counts decoded bytes, -1 meaning the data is at the end
+  byteSkip = header['byteSkip']
+  if encoding == 'gzip':
+    spans = _bgzfSpans(payload)
+    if spans and len(spans) > 1:
+      data = _inflateBlocks(payload, spans, threads or defaultThreads())
+    else:
+      data = _inflateStream(payload, None if byteSkip == -1 else byteSkip + nbytes)
+  elif encoding in ('bzip2', 'bz2'):
+    data = numpy.frombuffer(bz2.decompress(payload), dtype='u1')
+  elif encoding in ('ascii', 'text', 'txt'):
+    values = numpy.array(payload.split(), dtype=header['dtype'][1:])
+    data = values.astype(header['dtype']).view('u1')
+  else:
+    raise ValueError('Unsupported NRRD encoding: %s' % encoding)
+  if byteSkip == -1:
+    byteSkip = len(data) - nbytes
+  if byteSkip < 0 or len(data) < byteSkip + nbytes:
+    raise IOError('Volume data is shorter than its header says')
+  return data[byteSkip:byteSkip+nbytes]
+
+def _arrayFromPayload(payload, header):
+  return payload.view(header['dtype']).reshape(arrayShape(header))
+
+class FileCache(object):
+  """Files made from a volume, kept in a cache directory.
+  Entries are keyed by path, size and modification time of the source.
+  Each entry is some data files named after its key plus a key.json
+  metadata file, written last, with the 'source' path; the metadata is
+  touched on every hit, so its modification time orders eviction.
+  The least recently used entries are evicted once the total size goes
+  over maxBytes, and storing an entry removes the ones made from older
+  versions of the same source."""
+
+  def __init__(self, cacheDirectory, maxBytes):
+    self.cacheDirectory = cacheDirectory
+    self.maxBytes = maxBytes
+    self.lock = threading.Lock()
+
+  def makeDirectory(self):
+    if not os.path.exists(self.cacheDirectory):
+      try:
+        os.makedirs(self.cacheDirectory)
+      except OSError:
+        # another worker made it first
+        pass
+
+  def key(self, header):
+    stat = os.stat(header['dataPath'])
+    identity = '%s|%s|%d|%r' % (os.path.realpath(header['path']),
+                                os.path.realpath(header['dataPath']), stat.st_size, stat.st_mtime)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+  def metaPath(self, key):
+    return os.path.join(self.cacheDirectory, key + '.json')
+
+  def readMeta(self, key):
+    """The metadata of an entry (marking it as recently used), or None"""
+    metaPath = self.metaPath(key)
+    try:
+      fp = open(metaPath)
+      try:
+        meta = json.load(fp)
+      finally:
+        fp.close()
+    except (IOError, OSError, ValueError):
+      return None
+    try:
+      os.utime(metaPath, None)
+    except OSError:
+      pass
+    return meta
+
+  def writeMeta(self, key, header, meta):
+    """Complete an entry whose data files are written, then evict"""
+    meta = dict(meta)
+    source = os.path.realpath(header['path'])
+    meta['source'] = source
+    fp = open(self.metaPath(key), 'w')
+    json.dump(meta, fp)
+    fp.close()
+    self.evict(keep=key, replaced=source)
+
+  def writeArray(self, path, write):
+    """Write a data file through write(fp) and a rename, so a partial
+    file is never seen under its own name"""
+    fd, tmpPath = tempfile.mkstemp(dir=self.cacheDirectory, suffix='.tmp')
+    fp = os.fdopen(fd, 'wb')
+    try:
+      write(fp)
+    finally:
+      fp.close()
+    os.rename(tmpPath, path)
+
+  def _files(self):
+    """{key: [data file names]}"""
+    files = {}
+    if not os.path.exists(self.cacheDirectory):
+      return files
+    for fileName in os.listdir(self.cacheDirectory):
+      if fileName.endswith('.json') or fileName.endswith('.tmp'):
+        continue
+      # keys are sha1 hex digests
+      files.setdefault(fileName[:40], []).append(fileName)
+    return files
+
+  def entries(self):
+    """(lastUsed, bytes, key, source) for every entry, oldest first.
+    Entries without metadata are still being written (or broken) and
+    are dated by their newest data file."""
+    entries = []
+    for key, fileNames in self._files().items():
+      size = 0
+      lastUsed = 0
+      for fileName in fileNames:
+        try:
+          stat = os.stat(os.path.join(self.cacheDirectory, fileName))
+        except OSError:
+          continue
+        size += stat.st_size
+        lastUsed = max(lastUsed, stat.st_mtime)
+      source = None
+      try:
+        lastUsed = os.path.getmtime(self.metaPath(key))
+        fp = open(self.metaPath(key))
+        try:
+          source = json.load(fp).get('source')
+        finally:
+          fp.close()
+      except (IOError, OSError, ValueError, AttributeError):
+        pass
+      entries.append((lastUsed, size, key, source))
+    entries.sort()
+    return entries
+
+  def _remove(self, key, fileNames):
+    for fileName in [key + '.json'] + fileNames:
+      try:
+        os.remove(os.path.join(self.cacheDirectory, fileName))
+      except OSError:
+        pass
+
+  def evict(self, keep=None, replaced=None, maxBytes=None):
+    """Remove the entries of older versions of the replaced source
+    path, then least recently used ones until under maxBytes"""
+    if maxBytes is None:
+      maxBytes = self.maxBytes
+    self.lock.acquire()
+    try:
+      files = self._files()
+      entries = self.entries()
+      total = sum([entry[1] for entry in entries])
+      for lastUsed, size, key, source in entries:
+        if key == keep:
+          continue
+        if (replaced and source == replaced) or total > maxBytes:
+          self._remove(key, files.get(key, []))
+          total -= size
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.evict(maxBytes=0)
+
+class DecodedVolumeCache(FileCache):
+  """Decoded volumes kept as raw files on local scratch disk.
+  Hits come back as read-only memory maps.
+  """
+
+  def __init__(self, cacheDirectory=None, maxBytes=20 * 1024**3):
+    if not cacheDirectory:
+      cacheDirectory = os.path.join(tempfile.gettempdir(), 'MurineTrialCache')
+    FileCache.__init__(self, cacheDirectory, maxBytes)
+    self.makeDirectory()
+
+  def rawPath(self, key):
+    return os.path.join(self.cacheDirectory, key + '.raw')
+
+  def get(self, header):
+    """The cached array for the header, or None"""
+    key = self.key(header)
+    meta = self.readMeta(key)
+    if meta is None:
+      return None
+    try:
+      return numpy.memmap(self.rawPath(key), dtype=meta['dtype'], mode='r', shape=tuple(meta['shape']))
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+
+  def put(self, header, array):
+    """Store a decoded array (in native byte order) and return its memory map"""
+    key = self.key(header)
+    array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('='))
+    self.writeArray(self.rawPath(key), array.tofile)
+    self.writeMeta(key, header, {'dtype': array.dtype.str, 'shape': list(array.shape)})
+    return numpy.memmap(self.rawPath(key), dtype=array.dtype, mode='r', shape=array.shape)
+
+def readVolumeFromHeader(header, cache=None, threads=None):
+  """Decoded array for the header, going through the cache for compressed data"""
+  if header['encoding'] == 'raw':
+    return _arrayFromPayload(decodePayload(header, threads), header)
+  if cache:
+    array = cache.get(header)
+    if array is not None:
+      return array
+  array = _arrayFromPayload(decodePayload(header, threads), header)
+  if cache:
+    array = cache.put(header, array)
+  return array
+
+def readVolume(path, cache=None, threads=None):
+  """Read a NRRD or Analyze volume without Slicer.
+  Returns (array, header) with the array indexed [k,j,i]."""
+  header = readHeader(path)
+  return readVolumeFromHeader(header, cache, threads), header
+
+def readVolumes(paths, cache=None, threads=None):
+  """Read several volumes at once, decoding them in parallel threads.
+  Returns a list of (array, header) in the order of paths."""
+  threads = threads or defaultThreads()
+  if len(paths) < 2 or threads < 2:
+    return [readVolume(path, cache, threads) for path in paths]
+  pool = ThreadPool(min(threads, len(paths)))
+  try:
+    return pool.map(lambda path: readVolume(path, cache, threads), paths)
+  finally:
+    pool.close()
+    pool.join()
+
+def headerIJKToRAS(header):
+  """The 4x4 IJKToRAS of the header as nested lists.
+  Files without orientation (Analyze) get the LPS identity
+  orientation that ITK would give them."""
+  if header['ijkToRAS']:
+    return header['ijkToRAS']
+  spacing = header['spacing']
+  return [[-spacing[0], 0., 0., 0.],
+          [0., -spacing[1], 0., 0.],
+          [0., 0., spacing[2], 0.],
+          [0., 0., 0., 1.]]
@@ -0,0 +1,317 @@
+import os
+import re
+import struct
+
+#
+# Header-only access to the NRRD and Analyze files in the trial.
+# Nothing here reads voxel data, so a full catalog of the trial
+# can be built in a fraction of a second.
+#
+
+nrrdTypes = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2',
+  'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2',
+  'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+  'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8',
+  'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+}
+
+analyzeTypes = {
+  2: 'u1',
+  4: 'i2',
+  8: 'i4',
+  16: 'f4',
+  64: 'f8',
+  256: 'i1',
+  512: 'u2',
+  768: 'u4',
+}
+
+# the NRRD spaces that need a sign flip of the first two axes to be RAS
+lpsSpaces = ('left-posterior-superior', 'LPS', 'left-posterior-superior-time')
+
+def readHeader(path):
+  """Read the header of a NRRD (.nrrd, .nhdr) or Analyze (.hdr) file"""
+  extension = os.path.splitext(path)[1].lower()
+  if extension in ('.nrrd', '.nhdr'):
+    return readNRRDHeader(path)
+  if extension in ('.hdr', '.img'):
+    return readAnalyzeHeader(os.path.splitext(path)[0] + '.hdr')
+  raise ValueError('Unsupported volume format: %s' % path)
+
+def readNRRDHeader(path):
+  """Parse the text header of a NRRD file without touching the data.
+  Returns a dictionary with dimensions, spacing, dtype, encoding,
+  ijkToRAS (a 4x4 nested list or None) and where the data starts.
+  """
+  fp = open(path, 'rb')
+  try:
+    buffer = b''
+    while True:
+      chunk = fp.read(4096)
+      buffer += chunk
+      end = buffer.find(b'\n\n')
+      if end >= 0:
+        dataOffset = end + 2
+        break
+      end = buffer.find(b'\r\n\r\n')
+      if end >= 0:
+        dataOffset = end + 4
+        break
+      if not chunk:
+        # detached header with no trailing blank line
+        end = dataOffset = len(buffer)
+        break
+  finally:
+    fp.close()
+
+  lines = buffer[:end].decode('latin-1').splitlines()
+  if not lines or not lines[0].startswith('NRRD'):
+    raise ValueError('Not a NRRD file: %s' % path)
+
+  fields = {}
+  for line in lines[1:]:
+    if line.startswith('#') or ':=' in line or ': ' not in line:
+      continue
+    key, value = line.split(': ', 1)
+    fields[key.strip().lower()] = value.strip()
+
+  sizes = [int(s) for s in fields['sizes'].split()]
+  kinds = fields.get('kinds', '').split()
+  components = 1
+  if len(sizes) > 3 and kinds and kinds[0] not in ('domain', 'space'):
+    components = sizes[0]
+    sizes = sizes[1:]
+
+  header = {}
+  header['format'] = 'nrrd'
+  header['path'] = path
+  header['dimensions'] = tuple(sizes)
+  header['components'] = components
+  typeName = fields['type'].lower()
+  endian = '>' if fields.get('endian', 'little') == 'big' else '<'
+  header['dtype'] = endian + nrrdTypes[typeName]
+  encoding = fields.get('encoding', 'raw').lower()
+  if encoding == 'gz':
+    encoding = 'gzip'
+  header['encoding'] = encoding
+  header['lineSkip'] = int(fields.get('line skip', fields.get('lineskip', 0)))
+  header['byteSkip'] = int(fields.get('byte skip', fields.get('byteskip', 0)))
+
+  dataFile = fields.get('data file', fields.get('datafile'))
+  if dataFile:
+    header['dataPath'] = os.path.join(os.path.dirname(path), dataFile)
+    header['dataOffset'] = 0
+  else:
+    header['dataPath'] = path
+    header['dataOffset'] = dataOffset
+
+  header['ijkToRAS'] = None
+  spacing = None
+  if 'space directions' in fields:
+    directions = []
+    for token in re.findall(r'\(([^)]*)\)|none', fields['space directions']):
+      if token:
+        directions.append([float(v) for v in token.split(',')])
+    origin = [0., 0., 0.]
+    if 'space origin' in fields:
+      origin = [float(v) for v in fields['space origin'].strip('()').split(',')]
+    flip = [1., 1., 1.]
+    if fields.get('space') in lpsSpaces:
+      flip = [-1., -1., 1.]
+    if len(directions) == 3:
+      ijkToRAS = [[0.] * 4 for row in range(4)]
+      for column in range(3):
+        for row in range(3):
+          ijkToRAS[row][column] = flip[row] * directions[column][row]
+      for row in range(3):
+        ijkToRAS[row][3] = flip[row] * origin[row]
+      ijkToRAS[3][3] = 1.
+      header['ijkToRAS'] = ijkToRAS
+      spacing = tuple(sum([v * v for v in d]) ** 0.5 for d in directions)
+  if spacing is None and 'spacings' in fields:
+    values = [float(v) for v in fields['spacings'].split() if v.lower() != 'nan']
+    spacing = tuple(values[-3:])
+  if spacing is None:
+    spacing = (1., 1., 1.)
+  header['spacing'] = spacing
+  header['fileBytes'] = os.path.getsize(header['dataPath'])
+  return header
+
+def readAnalyzeHeader(path):
+  """Parse the fixed 348 byte Analyze 7.5 header.
+  Analyze has no reliable orientation so ijkToRAS is None.
+  """
+  fp = open(path, 'rb')
+  try:
+    raw = fp.read(348)
+  finally:
+    fp.close()
+  if len(raw) < 348:
+    raise ValueError('Truncated Analyze header: %s' % path)
+  endian = '<'
+  if struct.unpack('<i', raw[0:4])[0] != 348:
+    endian = '>'
+    if struct.unpack('>i', raw[0:4])[0] != 348:
+      raise ValueError('Not an Analyze header: %s' % path)
+  dim = struct.unpack(endian + '8h', raw[40:56])
+  datatype = struct.unpack(endian + 'h', raw[70:72])[0]
+  pixdim = struct.unpack(endian + '8f', raw[76:108])
+  voxOffset = struct.unpack(endian + 'f', raw[108:112])[0]
+
+  rank = max(3, min(dim[0], 7))
+  dimensions = [max(1, d) for d in dim[1:rank + 1]]
+  components = 1
+  for extra in dimensions[3:]:
+    components *= extra
+
+  header = {}
+  header['format'] = 'analyze'
+  header['path'] = path
+  header['dataPath'] = os.path.splitext(path)[0] + '.img'
+  header['dataOffset'] = int(voxOffset)
+  header['dimensions'] = tuple(dimensions[:3])
+  header['components'] = components
+  header['dtype'] = endian + analyzeTypes[datatype]
+  header['encoding'] = 'raw'
+  header['lineSkip'] = 0
+  header['byteSkip'] = 0
+  header['spacing'] = tuple(abs(p) if p else 1. for p in pixdim[1:4])
+  header['ijkToRAS'] = None
+  header['fileBytes'] = os.path.getsize(header['dataPath'])
+  return header
+
+def decodedBytes(header):
+  """Size in bytes of the volume once it is decoded in memory"""
+  voxels = header['components']
+  for size in header['dimensions']:
+    voxels *= size
+  return voxels * int(header['dtype'][2:])
+
+#
+# Catalog of all the materials
+#
+
+sampleIDPattern = re.compile(r'^(mouse|rat)\d+time\d+')
+
+def materialLabels(materials):
+  """The per-material keys (method.sampleID[retest]) of a materials dictionary"""
+  labels = [key for key in materials.keys() if isinstance(materials[key], dict)]
+  labels.sort()
+  return labels
+
+def buildHeaderCatalog(materials):
+  """Map each material label to the headers of its mr and seg files.
+  Paths shared by several materials are only read once.
+  """
+  headersByPath = {}
+  catalog = {}
+  for label in materialLabels(materials):
+    material = materials[label]
+    entry = {}
+    for role, pathKey in (('mr', 'mrPath'), ('seg', 'segPath')):
+      path = material[pathKey]
+      if path not in headersByPath:
+        headersByPath[path] = readHeader(path)
+      entry[role] = headersByPath[path]
+    catalog[label] = entry
+  return catalog
+
+def _close(a, b, tolerance):
+  for rowA, rowB in zip(a, b):
+    if not isinstance(rowA, (list, tuple)):
+      rowA, rowB = (rowA,), (rowB,)
+    for valueA, valueB in zip(rowA, rowB):
+      if abs(valueA - valueB) > tolerance:
+        return False
+  return True
+
+def _compare(sampleID, label, reference, header, referenceHeader, tolerance):
+  problems = []
+  if header['dimensions'] != referenceHeader['dimensions']:
+    problems.append(('dimensions', header['dimensions'], referenceHeader['dimensions']))
+  if not _close(header['spacing'], referenceHeader['spacing'], tolerance):
+    problems.append(('spacing', header['spacing'], referenceHeader['spacing']))
+  orientation = header['ijkToRAS']
+  referenceOrientation = referenceHeader['ijkToRAS']
+  if orientation is None or referenceOrientation is None:
+    # a volume without an orientation (Analyze) cannot be placed
+    # like one that has one, so that is an issue of its own
+    if (orientation is None) != (referenceOrientation is None):
+      problems.append(('ijkToRAS', orientation, referenceOrientation))
+  elif not _close(orientation, referenceOrientation, tolerance):
+    problems.append(('ijkToRAS', orientation, referenceOrientation))
+  issues = []
+  for field, value, expected in problems:
+    issue = {}
+    issue['sampleID'] = sampleID
+    issue['label'] = label
+    issue['reference'] = reference
+    issue['field'] = field
+    issue['value'] = value
+    issue['expected'] = expected
+    issues.append(issue)
+  return issues
+
+def geometryInconsistencies(catalog, referenceMethod='Slicer-seg', tolerance=1e-3):
+  """Compare geometry without loading voxels:
+  - the seg of each material against its mr
+  - the seg of each method against the referenceMethod seg of the same sample
+  (or the first method with an orientation when the reference is missing).
+  A missing orientation where the other volume has one is reported
+  as an ijkToRAS issue with the value None.
+  Returns a list of issue dictionaries.
+  """
+  issues = []
+  bySample = {}
+  for label in sorted(catalog.keys()):
+    method, rest = label.split('.', 1)
+    sampleID = sampleIDPattern.match(rest).group(0)
+    entry = catalog[label]
+    issues += _compare(sampleID, label+'-label', label, entry['seg'], entry['mr'], tolerance)
+    bySample.setdefault(sampleID, []).append(label)
+
+  for sampleID in sorted(bySample.keys()):
+    labels = bySample[sampleID]
+    reference = referenceMethod + '.' + sampleID
+    if reference not in catalog:
+      oriented = [l for l in labels if catalog[l]['seg']['ijkToRAS'] is not None]
+      reference = (oriented or labels)[0]
+    for label in labels:
+      if label != reference:
+        issues += _compare(sampleID, label, reference,
+                            catalog[label]['seg'], catalog[reference]['seg'], tolerance)
+  return issues
+
+def estimateResources(catalog, labels=None, inflateBytesPerSecond=60e6, readBytesPerSecond=200e6):
+  """Rough memory and time budget for loading the given materials
+  (all of them by default).  The rates are conservative single core
+  figures for zlib and local disk; adjust them for the machine at hand.
+  """
+  if labels is None:
+    labels = sorted(catalog.keys())
+  estimate = {'volumes': 0, 'voxels': 0, 'fileBytes': 0, 'decodedBytes': 0,
+              'peakMaterialBytes': 0, 'seconds': 0.}
+  for label in labels:
+    materialBytes = 0
+    for role in ('mr', 'seg'):
+      header = catalog[label][role]
+      nbytes = decodedBytes(header)
+      estimate['volumes'] += 1
+      estimate['voxels'] += nbytes // int(header['dtype'][2:])
+      estimate['fileBytes'] += header['fileBytes']
+      estimate['decodedBytes'] += nbytes
+      materialBytes += nbytes
+      estimate['seconds'] += header['fileBytes'] / readBytesPerSecond
+      if header['encoding'] != 'raw':
+        estimate['seconds'] += nbytes / inflateBytesPerSecond
+    estimate['peakMaterialBytes'] = max(estimate['peakMaterialBytes'], materialBytes)
+  return estimate
@@ -0,0 +1,142 @@
+import os
+import json
+import math
+import tempfile
+
+import numpy
+
+#
+# Per-subject label volumes over the timepoints of the trial.
+#
+# Only voxel counts are stored, so adding a timepoint means counting
+# one new segmentation; change from baseline and growth rates are
+# derived from the stored counts without reading older volumes.
+#
+
+trajectoryColumns = ('subject', 'label', 'time', 'volumeMM3', 'baselineTime',
+                     'changeFromBaselineMM3', 'changeFromBaselinePercent',
+                     'growthRateMM3', 'relativeGrowthRate')
+
+def labelCounts(labelArray):
+  """Voxel count of every non-zero label, from a single bincount"""
+  counts = numpy.bincount(numpy.asarray(labelArray).ravel().astype('intp'))
+  return dict([(int(label), int(counts[label])) for label in numpy.flatnonzero(counts) if label != 0])
+
+def fileStamp(path):
+  stat = os.stat(path)
+  return [stat.st_size, stat.st_mtime]
+
+class LongitudinalStore(object):
+  """Label voxel counts per subject and timepoint, kept in a json file.
+  entries[subject][time] = {'segPath', 'stamp', 'voxelVolumeMM3', 'counts'}
+  with time as a string (json keys) and counts keyed by label string.
+  """
+
+  def __init__(self, filePath):
+    self.filePath = filePath
+    self.entries = {}
+    if os.path.exists(filePath):
+      fp = open(filePath)
+      try:
+        self.entries = json.load(fp)
+      finally:
+        fp.close()
+
+  def stale(self, subject, time, segPath):
+    """True if the timepoint is missing or its segmentation changed"""
+    entry = self.entries.get(subject, {}).get(str(time))
+    if not entry or entry['segPath'] != segPath:
+      return True
+    return entry['stamp'] != fileStamp(segPath)
+
+  def record(self, subject, time, segPath, counts, voxelVolumeMM3):
+    entry = {}
+    entry['segPath'] = segPath
+    entry['stamp'] = fileStamp(segPath)
+    entry['voxelVolumeMM3'] = voxelVolumeMM3
+    entry['counts'] = dict([(str(label), count) for label, count in counts.items()])
+    self.entries.setdefault(subject, {})[str(time)] = entry
+
+  def retain(self, timepoints):
+    """Drop the entries whose (subject, time) is not in timepoints,
+    e.g. after their segmentation was deleted.
+    Returns the dropped (subject, time) pairs."""
+    timepoints = set([(subject, str(time)) for subject, time in timepoints])
+    dropped = []
+    for subject in list(self.entries.keys()):
+      for time in list(self.entries[subject].keys()):
+        if (subject, time) not in timepoints:
+          del self.entries[subject][time]
+          dropped.append((subject, int(time)))
+      if not self.entries[subject]:
+        del self.entries[subject]
+    return sorted(dropped)
+
+  def save(self):
+    directory = os.path.dirname(self.filePath) or '.'
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    fd, tmpPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    fp = os.fdopen(fd, 'w')
+    try:
+      json.dump(self.entries, fp, indent=1, sort_keys=True)
+    finally:
+      fp.close()
+    if os.path.exists(self.filePath):
+      os.remove(self.filePath)
+    os.rename(tmpPath, self.filePath)
+
+  def volumes(self, subject):
+    """{label: {time: volumeMM3}} for the subject"""
+    volumes = {}
+    for time, entry in self.entries.get(subject, {}).items():
+      for label, count in entry['counts'].items():
+        volumes.setdefault(int(label), {})[int(time)] = count * entry['voxelVolumeMM3']
+    return volumes
+
+  def trajectories(self, timepointDays=None):
+    """One row per subject, label and timepoint with the change from
+    the subject's first timepoint and the growth since the previous one.
+    Rates are per timepoint step, or per day when timepointDays maps
+    each timepoint to its study day.  Labels missing at a timepoint
+    count as zero volume there."""
+    if timepointDays is None:
+      timepointDays = {}
+    rows = []
+    for subject in sorted(self.entries.keys()):
+      times = sorted([int(time) for time in self.entries[subject].keys()])
+      baselineTime = times[0]
+      volumes = self.volumes(subject)
+      for label in sorted(volumes.keys()):
+        trajectory = volumes[label]
+        baseline = trajectory.get(baselineTime, 0.)
+        previousTime = None
+        for time in times:
+          volume = trajectory.get(time, 0.)
+          row = {}
+          row['subject'] = subject
+          row['label'] = label
+          row['time'] = time
+          row['volumeMM3'] = volume
+          row['baselineTime'] = baselineTime
+          row['changeFromBaselineMM3'] = volume - baseline
+          row['changeFromBaselinePercent'] = 100. * (volume - baseline) / baseline if baseline else float('nan')
+          row['growthRateMM3'] = float('nan')
+          row['relativeGrowthRate'] = float('nan')
+          if previousTime is not None:
+            previous = trajectory.get(previousTime, 0.)
+            elapsed = timepointDays.get(time, time) - timepointDays.get(previousTime, previousTime)
+            if elapsed:
+              row['growthRateMM3'] = (volume - previous) / float(elapsed)
+              if previous > 0 and volume > 0:
+                row['relativeGrowthRate'] = math.log(volume / previous) / elapsed
+          previousTime = time
+          rows.append(row)
+    return rows
+
+  def trajectoriesCSV(self, filePath, timepointDays=None):
+    fp = open(filePath, 'w')
+    fp.write(','.join(trajectoryColumns) + '\n')
+    for row in self.trajectories(timepointDays):
+      fp.write(','.join([str(row[column]) for column in trajectoryColumns]) + '\n')
+    fp.close()
@@ -0,0 +1,142 @@
+import numpy
+
+#
+# Shape measurements for every label of a label map at once.
+#
+# All the per-label quantities come from labeled reductions
+# (numpy.bincount keyed by label value) over the foreground voxels,
+# so the cost is about that of counting voxels, independent of the
+# number of labels, and no meshes are built.
+#
+
+morphometricColumns = ('centroidR', 'centroidA', 'centroidS', 'lengthMM', 'surfaceAreaMM2')
+
+def _affine(ijkToRAS, spacing):
+  if ijkToRAS is None:
+    matrix = numpy.diag(list(spacing) + [1.])
+  else:
+    matrix = numpy.array(ijkToRAS, dtype='float64')
+  return matrix[:3, :3], matrix[:3, 3]
+
+def _moments(labelArray, bins, chunkVoxels):
+  """Per-label sums of 1, i, j, k and the six second order products,
+  over chunks of the foreground so memory stays bounded"""
+  sums = numpy.zeros((10, bins))
+  center = (numpy.array(labelArray.shape[::-1], dtype='float64') - 1) / 2.
+  flat = labelArray.ravel()
+  foreground = numpy.flatnonzero(flat)
+  for start in range(0, len(foreground), chunkVoxels):
+    indices = foreground[start:start + chunkVoxels]
+    labels = flat[indices].astype('intp')
+    k, j, i = numpy.unravel_index(indices, labelArray.shape)
+    # centered coordinates keep the second moments well conditioned
+    x = i - center[0]
+    y = j - center[1]
+    z = k - center[2]
+    for row, weights in enumerate((None, x, y, z, x*x, y*y, z*z, x*y, x*z, y*z)):
+      sums[row] += numpy.bincount(labels, weights=weights, minlength=bins)[:bins]
+  return sums, center
+
+def _boundaryFaces(labelArray, bins, faceAreas):
+  """Per-label area of the voxel faces that separate a label from
+  anything else, including the faces on the edge of the volume"""
+  area = numpy.zeros(bins)
+  for axis in range(3):
+    lower = [slice(None)] * 3
+    upper = [slice(None)] * 3
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    a = labelArray[tuple(lower)]
+    b = labelArray[tuple(upper)]
+    differ = a != b
+    faces = numpy.bincount(a[differ].astype('intp'), minlength=bins)[:bins]
+    faces += numpy.bincount(b[differ].astype('intp'), minlength=bins)[:bins]
+    first = [slice(None)] * 3
+    last = [slice(None)] * 3
+    first[axis] = 0
+    last[axis] = -1
+    faces += numpy.bincount(labelArray[tuple(first)].ravel().astype('intp'), minlength=bins)[:bins]
+    faces += numpy.bincount(labelArray[tuple(last)].ravel().astype('intp'), minlength=bins)[:bins]
+    # array axes are k,j,i so axis 0 faces are normal to k
+    area += faces * faceAreas[2 - axis]
+  return area
+
+def labelMorphometrics(labelArray, ijkToRAS=None, spacing=(1., 1., 1.), labels=None, chunkVoxels=1 << 22):
+  """Volume, centroid, principal axes, length and surface area of each label.
+
+  labelArray is indexed [k,j,i] as returned by slicer.util.array.
+  ijkToRAS is a 4x4 (nested lists or array); without it the spacing
+  is used with the volume axes.  Returns a dictionary keyed by label
+  value with:
+    voxels, volumeMM3
+    centroid (RAS)
+    axes: principal directions as rows, longest first
+    axisLengthsMM: full lengths of the ellipsoid with the same second moments
+    lengthMM: the longest of those
+    faceAreaMM2: area of the exposed voxel faces
+    surfaceAreaMM2: faceAreaMM2 * 2/3, correcting for the staircase
+                    overestimate of randomly oriented surfaces
+  """
+  labelArray = numpy.asarray(labelArray)
+  if labels is None:
+    labels = [int(l) for l in numpy.unique(labelArray) if l != 0]
+  bins = int(max(list(labels) + [int(labelArray.max()), 0])) + 1
+  matrix, translation = _affine(ijkToRAS, spacing)
+  columnLengths = numpy.sqrt((matrix ** 2).sum(axis=0))
+  voxelVolume = abs(numpy.linalg.det(matrix))
+  faceAreas = (columnLengths[1] * columnLengths[2],
+               columnLengths[0] * columnLengths[2],
+               columnLengths[0] * columnLengths[1])
+
+  sums, center = _moments(labelArray, bins, chunkVoxels)
+  faceArea = _boundaryFaces(labelArray, bins, faceAreas)
+
+  labels = numpy.array(labels, dtype='intp')
+  counts = sums[0, labels]
+  present = counts > 0
+  safeCounts = numpy.where(present, counts, 1.)
+  mean = sums[1:4, labels] / safeCounts
+  xx, yy, zz, xy, xz, yz = sums[4:10, labels] / safeCounts
+  mx, my, mz = mean
+  covariance = numpy.empty((len(labels), 3, 3))
+  covariance[:, 0, 0] = xx - mx*mx
+  covariance[:, 1, 1] = yy - my*my
+  covariance[:, 2, 2] = zz - mz*mz
+  covariance[:, 0, 1] = covariance[:, 1, 0] = xy - mx*my
+  covariance[:, 0, 2] = covariance[:, 2, 0] = xz - mx*mz
+  covariance[:, 1, 2] = covariance[:, 2, 1] = yz - my*mz
+
+  # into physical space: x_ras = M x_ijk + t
+  centroids = numpy.dot(matrix, mean + center[:, numpy.newaxis]).T + translation
+  covariance = numpy.einsum('ab,nbc,dc->nad', matrix, covariance, matrix)
+  eigenvalues, eigenvectors = numpy.linalg.eigh(covariance)
+  # eigh sorts ascending: put the major axis first
+  eigenvalues = numpy.clip(eigenvalues[:, ::-1], 0, None)
+  eigenvectors = eigenvectors[:, :, ::-1]
+  # a solid ellipsoid with semi-axis a has variance a*a/5 along it
+  axisLengths = 2. * numpy.sqrt(5. * eigenvalues)
+
+  results = {}
+  for index, label in enumerate(labels):
+    result = {}
+    result['voxels'] = int(counts[index])
+    result['volumeMM3'] = counts[index] * voxelVolume
+    if present[index]:
+      result['centroid'] = tuple(centroids[index])
+      result['axes'] = eigenvectors[index].T.copy()
+      result['axisLengthsMM'] = tuple(axisLengths[index])
+      result['lengthMM'] = axisLengths[index][0]
+    else:
+      result['centroid'] = (float('nan'),) * 3
+      result['axes'] = numpy.zeros((3, 3)) * float('nan')
+      result['axisLengthsMM'] = (float('nan'),) * 3
+      result['lengthMM'] = float('nan')
+    result['faceAreaMM2'] = faceArea[label]
+    result['surfaceAreaMM2'] = faceArea[label] * 2. / 3.
+    results[int(label)] = result
+  return results
+
+def morphometricValues(result):
+  """The values for morphometricColumns from one labelMorphometrics entry"""
+  centroid = result['centroid']
+  return (centroid[0], centroid[1], centroid[2], result['lengthMM'], result['surfaceAreaMM2'])
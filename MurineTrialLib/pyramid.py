@@ -0,0 +1,112 @@
+import os
+
+import numpy
+
+from .decode import headerIJKToRAS, FileCache
+
+#
+# Downsampled copies of the volumes for quick-look browsing.
+# Each level halves every axis that is still longer than one voxel:
+# MR levels average the voxels of each block, label levels keep the
+# most common label of the block (mode pooling) so no label values
+# are invented at the boundaries.
+#
+
+def _blocks(array, factors):
+  """View of the edge-padded array as (k, j, i, voxels-per-block)"""
+  pad = [(0, (-size) % factor) for size, factor in zip(array.shape, factors)]
+  if any([after for before, after in pad]):
+    array = numpy.pad(array, pad, mode='edge')
+  fk, fj, fi = factors
+  k, j, i = array.shape[0] // fk, array.shape[1] // fj, array.shape[2] // fi
+  blocks = array.reshape(k, fk, j, fj, i, fi).transpose(0, 2, 4, 1, 3, 5)
+  return blocks.reshape(k, j, i, fk * fj * fi)
+
+def downsampleMean(array, factors):
+  """Average of each block of voxels, as float32"""
+  return _blocks(array, factors).mean(axis=-1, dtype='float64').astype('float32')
+
+def downsampleMode(labelArray, factors):
+  """Most common label of each block of voxels (ties go to the
+  smaller label value).  One comparison pass per label value, which
+  is cheap for label maps with a handful of labels."""
+  blocks = _blocks(labelArray, factors)
+  values = numpy.unique(blocks)
+  best = numpy.zeros(blocks.shape[:3], dtype=labelArray.dtype)
+  bestCount = -numpy.ones(blocks.shape[:3], dtype='int32')
+  for value in values:
+    count = (blocks == value).sum(axis=-1, dtype='int32')
+    better = count > bestCount
+    best[better] = value
+    bestCount[better] = count[better]
+  return best
+
+def levelFactors(shape):
+  """Per-axis factors for one pyramid step (halve axes longer than one)"""
+  return tuple([2 if size > 1 else 1 for size in shape])
+
+def downsampledHeader(header, array, totalFactors):
+  """Header for a level: dimensions from the array, spacing scaled and
+  the origin moved to the center of the first block"""
+  fk, fj, fi = totalFactors
+  ijkToRAS = numpy.array(headerIJKToRAS(header), dtype='float64')
+  scale = numpy.array([[fi, 0, 0, (fi - 1) / 2.],
+                       [0, fj, 0, (fj - 1) / 2.],
+                       [0, 0, fk, (fk - 1) / 2.],
+                       [0, 0, 0, 1.]])
+  levelHeader = dict(header)
+  levelHeader['dimensions'] = (array.shape[2], array.shape[1], array.shape[0])
+  levelHeader['components'] = 1
+  levelHeader['dtype'] = array.dtype.str
+  levelHeader['spacing'] = tuple([s * f for s, f in zip(header['spacing'], (fi, fj, fk))])
+  levelHeader['ijkToRAS'] = numpy.dot(ijkToRAS, scale).tolist()
+  levelHeader['previewFactors'] = (fi, fj, fk)
+  return levelHeader
+
+def buildPyramid(array, header, levels, labelMap=False):
+  """List of (array, header) for levels 1..levels (level 0 is the
+  original), each computed from the one before"""
+  pyramid = []
+  totalFactors = (1, 1, 1)
+  reduce = downsampleMode if labelMap else downsampleMean
+  for level in range(levels):
+    factors = levelFactors(array.shape)
+    if factors == (1, 1, 1):
+      break
+    array = reduce(array, factors)
+    totalFactors = tuple([t * f for t, f in zip(totalFactors, factors)])
+    pyramid.append((array, downsampledHeader(header, array, totalFactors)))
+  return pyramid
+
+class PreviewPyramidCache(FileCache):
+  """Pyramid levels stored as .npy files, keyed and evicted like the
+  decoded volume cache."""
+
+  def __init__(self, cacheDirectory, maxBytes=2 * 1024**3):
+    FileCache.__init__(self, cacheDirectory, maxBytes)
+
+  def levelPath(self, key, level):
+    return os.path.join(self.cacheDirectory, '%s-%d.npy' % (key, level))
+
+  def get(self, header, level):
+    """(array, levelHeader) of the cached level closest to the one asked
+    for, or None if the volume has no pyramid yet"""
+    key = self.key(header)
+    meta = self.readMeta(key)
+    if not isinstance(meta, dict) or not meta.get('levels'):
+      return None
+    levelHeaders = meta['levels']
+    level = max(1, min(level, len(levelHeaders)))
+    try:
+      array = numpy.load(self.levelPath(key, level), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+      return None
+    return array, levelHeaders[level - 1]
+
+  def put(self, header, pyramid):
+    self.makeDirectory()
+    key = self.key(header)
+    for level, (array, levelHeader) in enumerate(pyramid):
+      self.writeArray(self.levelPath(key, level + 1), lambda fp: numpy.save(fp, array))
+    # the metadata goes last so a partial pyramid is never used
+    self.writeMeta(key, header, {'levels': [levelHeader for array, levelHeader in pyramid]})
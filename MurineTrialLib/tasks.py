@@ -0,0 +1,126 @@
+import time
+import threading
+import traceback
+import multiprocessing
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+class BackgroundTask(object):
+  """Run function(task, *args) in a daemon thread.
+  The function hands results back with task.post(item) and should
+  return early once task.cancelled() is true.  Nothing is delivered
+  to the caller's thread directly: the GUI polls task.results()
+  (typically from a qt.QTimer) and touches the scene and widgets itself.
+  """
+
+  def __init__(self, function, *args):
+    self.function = function
+    self.args = args
+    self.queue = queue.Queue()
+    self.cancelEvent = threading.Event()
+    self.finishedEvent = threading.Event()
+    self.error = None
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+
+  def _run(self):
+    try:
+      self.function(self, *self.args)
+    except Exception:
+      self.error = traceback.format_exc()
+    finally:
+      self.finishedEvent.set()
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def post(self, item):
+    self.queue.put(item)
+
+  def cancel(self):
+    self.cancelEvent.set()
+
+  def cancelled(self):
+    return self.cancelEvent.is_set()
+
+  def finished(self):
+    """True once the function has returned and every result was collected"""
+    return self.finishedEvent.is_set() and self.queue.empty()
+
+  def results(self):
+    """All the results posted since the last call, without blocking"""
+    items = []
+    while True:
+      try:
+        items.append(self.queue.get_nowait())
+      except queue.Empty:
+        return items
+
+class JobScheduler(object):
+  """Keep up to concurrency asynchronous jobs (such as CLI module runs)
+  going at once.  launch(job) starts a job and returns a handle,
+  state(handle) is 'running', 'done' or 'failed'.  Everything happens
+  on the caller's thread from poll(): finished jobs are handed to
+  onFinished(job, handle, succeeded) as soon as they are seen, and
+  queued jobs are launched into the free slots.
+  """
+
+  def __init__(self, launch, state, concurrency=None, onFinished=None):
+    self.launch = launch
+    self.state = state
+    if not concurrency:
+      try:
+        concurrency = multiprocessing.cpu_count()
+      except NotImplementedError:
+        concurrency = 1
+    self.concurrency = concurrency
+    self.onFinished = onFinished
+    self.queued = []
+    self.running = []
+    self.failed = []
+
+  def submit(self, job):
+    self.queued.append(job)
+
+  def poll(self):
+    """Collect the finished jobs and start queued ones.
+    Returns the (job, handle, succeeded) that finished."""
+    finished = []
+    stillRunning = []
+    for job, handle in self.running:
+      state = self.state(handle)
+      if state == 'running':
+        stillRunning.append((job, handle))
+      else:
+        finished.append((job, handle, state == 'done'))
+    self.running = stillRunning
+    for job, handle, succeeded in finished:
+      if not succeeded:
+        self.failed.append(job)
+      if self.onFinished:
+        self.onFinished(job, handle, succeeded)
+    while self.queued and len(self.running) < self.concurrency:
+      job = self.queued.pop(0)
+      self.running.append((job, self.launch(job)))
+    return finished
+
+  def done(self):
+    return not self.queued and not self.running
+
+  def wait(self, idle=None, interval=0.05, timeout=None):
+    """Poll every interval seconds until all the jobs have finished,
+    calling idle() in between (e.g. to process GUI events so CLI nodes
+    update).  Returns False if timeout seconds pass first."""
+    start = time.time()
+    self.poll()
+    while not self.done():
+      if timeout is not None and time.time() - start > timeout:
+        return False
+      if idle:
+        idle()
+      time.sleep(interval)
+      self.poll()
+    return True
@@ -0,0 +1,33 @@
+import numpy
+
+#
+# Label volumes and the per-slice counts of the IMAT fat ratio, from plain arrays
+# (indexed [k,j,i] like slicer.util.array)
+#
+
+def labelVolume(labelArray, spacing, index):
+  """Volume in mm3 of the voxels with the given label value"""
+  return numpy.array(spacing, dtype='float64').prod() * numpy.count_nonzero(numpy.asarray(labelArray) == index)
+
+def imatMask(classmapArray, imatLabel=5):
+  """1 where the CRO classmap marks intermuscular fat (IMAT), else 0.
+  Color classmaps mark IMAT with a non-zero green component,
+  scalar ones with the imatLabel value."""
+  classmapArray = numpy.asarray(classmapArray)
+  if classmapArray.ndim > 3 and classmapArray.shape[3] > 1:
+    return (classmapArray[..., 1] != 0).astype('uint8')
+  return (classmapArray == imatLabel).astype('uint8')
+
+def perSliceCounts(muscleMask, imatMask):
+  """Per-slice muscle and muscle IMAT voxel counts, restricted to the
+  slices where both the muscle and the classmap IMAT are present
+  (elsewhere the classmap is missing data).
+  Returns (slices, muscleCounts, muscleIMATCounts) as arrays."""
+  muscleMask = numpy.asarray(muscleMask) != 0
+  imatMask = numpy.asarray(imatMask) != 0
+  sliceCount = muscleMask.shape[0]
+  muscleCounts = muscleMask.reshape(sliceCount, -1).sum(axis=1)
+  imatPresent = imatMask.reshape(sliceCount, -1).any(axis=1)
+  muscleIMATCounts = (muscleMask & imatMask).reshape(sliceCount, -1).sum(axis=1)
+  slices = numpy.flatnonzero((muscleCounts > 0) & imatPresent)
+  return slices, muscleCounts[slices], muscleIMATCounts[slices]
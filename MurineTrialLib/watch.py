@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+
+#
+# Noticing new or rewritten files in the data folders and updating
+# the result csv files for just the rows they affect.
+#
+
+def pathStamp(path):
+  """(size, mtime) of the file, or None if it is not there"""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return (stat.st_size, stat.st_mtime)
+
+class FileSettler(object):
+  """Track the (size, mtime) of files from one poll to the next and
+  report the ones that changed since they were last reported once they
+  have stayed the same for settleSeconds, so files that are still being
+  written (or copied in) are not read half done."""
+
+  def __init__(self, settleSeconds=30., clock=time.time):
+    self.settleSeconds = settleSeconds
+    self.clock = clock
+    self.reported = {}
+    self.pending = {}
+
+  def prime(self, paths):
+    """Take the current state of the paths as already reported"""
+    for path in paths:
+      stamp = pathStamp(path)
+      if stamp:
+        self.reported[path] = stamp
+
+  def poll(self, paths):
+    """Returns (settled, removed): the paths that changed and have
+    settled, and the reported paths that are no longer there"""
+    now = self.clock()
+    settled = []
+    paths = set(paths)
+    for path in paths:
+      stamp = pathStamp(path)
+      if stamp is None or stamp == self.reported.get(path):
+        self.pending.pop(path, None)
+        continue
+      pendingStamp,since = self.pending.get(path, (None, None))
+      if pendingStamp != stamp:
+        self.pending[path] = (stamp, now)
+      elif now - since >= self.settleSeconds:
+        self.reported[path] = stamp
+        del self.pending[path]
+        settled.append(path)
+    removed = []
+    for path in list(self.reported.keys()):
+      if path not in paths or pathStamp(path) is None:
+        del self.reported[path]
+        removed.append(path)
+    return sorted(settled), sorted(removed)
+
+def replaceCSVRows(filePath, rows, keyColumns):
+  """Replace the lines of a csv file whose first keyColumns cells
+  match a key of rows (a tuple of strings) with the new row text, or
+  drop them if the row is None.  Rows with no matching line are
+  appended and repeated lines for a key are dropped.
+  The file is rewritten atomically."""
+  lines = []
+  if os.path.exists(filePath):
+    fp = open(filePath)
+    lines = fp.readlines()
+    fp.close()
+  pending = dict(rows)
+  updated = []
+  for index, line in enumerate(lines):
+    key = tuple([cell.strip() for cell in line.split(',')[:keyColumns]])
+    if index == 0 or key not in rows:
+      updated.append(line)
+    elif key in pending:
+      # the first line for the key gets the new row, repeats are dropped
+      row = pending.pop(key)
+      if row is not None:
+        updated.append(row.rstrip('\n') + '\n')
+  for key in sorted(pending.keys()):
+    if pending[key] is not None:
+      updated.append(pending[key].rstrip('\n') + '\n')
+  directory = os.path.dirname(filePath) or '.'
+  fd, tmpPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  fp = os.fdopen(fd, 'w')
+  try:
+    fp.writelines(updated)
+  finally:
+    fp.close()
+  if os.path.exists(filePath):
+    os.remove(filePath)
+  os.rename(tmpPath, filePath)